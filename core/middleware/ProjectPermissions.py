@@ -0,0 +1,11 @@
+from project.permissions import PermissionResolver
+
+class ProjectPermissions(object):
+    """
+    Attaches a PermissionResolver to each request as request.project_permissions, so a
+    user's permissions on a project are worked out once and shared by the permission
+    decorators, the views and the templates.  Must come after AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        request.project_permissions = PermissionResolver(request)
+        return None
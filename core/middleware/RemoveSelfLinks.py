@@ -2,7 +2,8 @@ import re
 
 class RemoveSelfLinks:
     def process_response(self, request, response):
-        if response.status_code == 200:
+        # Only rewrite html, streamed downloads must not be read into memory here
+        if response.status_code == 200 and response.get('Content-Type', '').startswith('text/html'):
             link = request.META['PATH_INFO']
             response.content = \
                 re.sub( \
@@ -12,6 +12,7 @@ from django.template.defaultfilters import slugify
 from core.configs import IssueOptions
 from issue.signals import *
 from project.models import Project
+from project.signals import update_issue_counter
 from repo.models import Repo
 
 class IssueType(models.Model):
@@ -169,3 +170,5 @@ class Issue(models.Model):
         ordering = ['-created_date']
 #Dispatchers
 signals.post_save.connect( send_email_to_owner , sender=Issue )
+signals.post_save.connect( update_issue_counter , sender=Issue )
+signals.post_delete.connect( update_issue_counter , sender=Issue )
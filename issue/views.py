@@ -12,6 +12,7 @@ from issue.models import *
 from issue.forms import IssueCreateForm, IssueEditForm
 from project.models import Project
 from project.decorators import check_project_permissions
+from project.permissions import get_permissions
 
 @check_project_permissions('view_issues')
 def issue_list(request, slug):
@@ -79,7 +80,7 @@ def issue_list(request, slug):
         {
             'project':project,
             'issue_list':issues,
-            'permissions':project.get_permissions(request.user),
+            'permissions':get_permissions(request, project),
             'pages':pages,
             'current_page':page+1
         }, context_instance=RequestContext(request)
@@ -101,7 +102,7 @@ def issue_detail(request, slug, issue_id):
         {
             'project':project,
             'issue':issue,
-            'permissions':project.get_permissions(request.user),
+            'permissions':get_permissions(request, project),
         }, context_instance=RequestContext(request)
     )
 
@@ -138,7 +139,7 @@ def issue_create(request, slug):
         {
             'form':form, 
             'project':project, 
-            'permissions':project.get_permissions(request.user)
+            'permissions':get_permissions(request, project)
         }, context_instance=RequestContext(request)
     )
 
@@ -183,6 +184,6 @@ def issue_edit(request, slug, issue_id):
             'form':form,
             'issue':issue,
             'project':project,
-            'permissions':project.get_permissions(request.user)
+            'permissions':get_permissions(request, project)
         }, context_instance=RequestContext(request)
     )
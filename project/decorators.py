@@ -18,22 +18,22 @@ def check_project_permissions(*args):
     as a keyword argument, not just a normal argument. That means that the urlconf must call it as
     ?P<slug>
     """
-    required_permissions = args
+    from project.permissions import Permissions
+    required_permissions = Permissions.from_names(*args)
     def the_decorator(func):
         from project.models import Project
         from django.shortcuts import get_object_or_404
         from django.http import HttpResponseForbidden
         from django.template.loader import Context, render_to_string
+        from project.permissions import get_resolver
         def inner(*args, **kwargs):
             request = args[0]
             # FIXME: Weird hack, had to add the print statement to stop the ORM failing on line 31
             #print request
             #import pdb; pdb.set_trace()
             project = get_object_or_404(Project, project_id__exact=str(kwargs['slug']))
-            project_permissions = project.get_permissions(request.user)
-            for permission in required_permissions:
-                if not getattr(project_permissions, permission):
-                    return HttpResponseForbidden(render_to_string('403.html'))
+            if not get_resolver(request).has_permissions(project, required_permissions):
+                return HttpResponseForbidden(render_to_string('403.html'))
             return func(*args, **kwargs)
         return inner
     return the_decorator
\ No newline at end of file
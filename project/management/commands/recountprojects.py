@@ -0,0 +1,26 @@
+# General Libraries
+# Django Libraries
+from django.core.management.base import BaseCommand, CommandError
+# Project Libraries
+
+class Command(BaseCommand):
+    help = 'Recomputes the repository, member, size and issue counters of the projects from scratch.'
+    args = '[project_id ...]'
+
+    def handle(self, *args, **options):
+        from project.models import Project
+        verbosity = int(options.get('verbosity', 1))
+        
+        projects = Project.projects.all()
+        if args:
+            projects = projects.filter(project_id__in=args)
+            if projects.count() != len(set(args)):
+                found = [p.project_id for p in projects]
+                raise CommandError("Unknown project: %s" % ', '.join([a for a in args if a not in found]))
+        
+        for project_id, slug in projects.values_list('id', 'project_id'):
+            Project.projects.update_counters(project_id)
+            if verbosity > 0:
+                project = Project.projects.get(id=project_id)
+                print "%s: %s repositories, %s members, %s bytes, %s issues" % (slug, project.repo_count,
+                    project.member_count, project.repo_size, project.issue_count)
@@ -9,8 +9,12 @@ from django.dispatch import dispatcher
 from django.utils.translation import gettext_lazy as _
 # Project Libraries
 from core.configs import ProjectOptions
+from project.permissions import PERMISSION_NAMES, Permissions, cached_permissions, invalidate_project_permissions
 from project.signals import *
 
+# The denormalized counters on Project, kept up to date by update_counters
+COUNTER_FIELDS = ('repo_count', 'repo_size', 'member_count', 'issue_count')
+
 class ProjectManager(models.Manager):
     """
     Manager class for Project.
@@ -30,6 +34,64 @@ class ProjectManager(models.Manager):
             projectpermissionset__owner_accepted = True
         )
 
+    def visible_to(self, user):
+        """
+        Returns the projects the user `user` may view, following the same rules as
+        Project.get_permissions but as a single query: the user manages the project, or
+        is an accepted member whose permission set allows viewing it, or isn't a member
+        and the project's default permission set allows viewing it.
+        """
+        from django.db import connection
+        qn = connection.ops.quote_name
+        project_table = qn(self.model._meta.db_table)
+        permission_table = qn(ProjectPermissionSet._meta.db_table)
+        member_sets = "SELECT 1 FROM %s pps WHERE pps.project_id = %s.id AND pps.user_id = %%s \
+                       AND pps.user_accepted = %%s AND pps.owner_accepted = %%s" % (permission_table, project_table)
+        default_sets = "SELECT 1 FROM %s pps WHERE pps.project_id = %s.id AND pps.is_default = %%s \
+                        AND pps.view_project = %%s" % (permission_table, project_table)
+        if not user.is_authenticated():
+            return self.extra(where=["EXISTS (%s)" % default_sets], params=[True, True])
+        return self.extra(
+            where=["(%s.project_manager_id = %%s OR EXISTS (%s AND pps.view_project = %%s) \
+                    OR (NOT EXISTS (%s) AND EXISTS (%s)))" % (project_table, member_sets, member_sets, default_sets)],
+            params=[user.id, user.id, True, True, True, user.id, True, True, True, True]
+        )
+
+    def update_counters(self, project_id, counters=None):
+        """
+        Recomputes the denormalized counter columns of the project from the rows they
+        count, or only the ones named in `counters`.  They are written with an UPDATE
+        rather than save(), so the project's post_save signals don't fire again.
+        """
+        from django.db import connection
+        from repo.models import Repo
+        from issue.models import Issue
+        if counters is None:
+            counters = COUNTER_FIELDS
+        values = {}
+        if 'repo_count' in counters:
+            values['repo_count'] = Repo.objects.filter(local_parent_project__id=project_id).count()
+        if 'repo_size' in counters:
+            cursor = connection.cursor()
+            cursor.execute("SELECT SUM(folder_size) FROM %s WHERE local_parent_project_id=%%s" % \
+                           connection.ops.quote_name(Repo._meta.db_table), [project_id])
+            values['repo_size'] = cursor.fetchone()[0] or 0
+        if 'member_count' in counters:
+            try:
+                manager_id = self.filter(id=project_id).values('project_manager')[0]['project_manager']
+            except IndexError:
+                # There is no project left to count the members of
+                manager_id = None
+            if manager_id is not None:
+                # The members other than the owner, who doesn't need a permission set
+                members = ProjectPermissionSet.objects.filter(project__id=project_id, is_default=False,
+                            user_accepted=True, owner_accepted=True).exclude(user__id=manager_id)
+                values['member_count'] = members.count() + 1
+        if 'issue_count' in counters:
+            values['issue_count'] = Issue.objects.filter(project__id=project_id).count()
+        if values:
+            self.filter(id=project_id).update(**values)
+
     def project_invitations(self, user):
         """
         This returns a list of projects that the user `user` has yet to accept
@@ -85,6 +147,15 @@ class Project(models.Model):
     created_date=models.DateTimeField(_('created on'), auto_now_add=True, editable=False, help_text=_('the date this project was started'))
     # modified_date: The date the project instance was last modified
     modified_date=models.DateTimeField(_('modified on'), auto_now=True, editable=False, help_text=_('the date the project was last updated'))
+    # repo_count: The number of repositories in the project, kept up to date by signals
+    repo_count=models.PositiveIntegerField(_('number of repositories'), default=0, editable=False, help_text=_('the number of repositories in the project'))
+    # repo_size: The total folder_size of the project's repositories, kept up to date by signals.
+    # A DecimalField, as the total can be more than an IntegerField holds
+    repo_size=models.DecimalField(_('total size'), max_digits=20, decimal_places=0, default=0, editable=False, help_text=_('the total size of the repositories in the project'))
+    # member_count: The number of members including the owner, kept up to date by signals
+    member_count=models.PositiveIntegerField(_('number of members'), default=1, editable=False, help_text=_('the number of members of the project, including the owner'))
+    # issue_count: The number of issues in the project, kept up to date by signals
+    issue_count=models.PositiveIntegerField(_('number of issues'), default=0, editable=False, help_text=_('the number of issues in the project'))
 
     # Model properties
     
@@ -129,6 +200,9 @@ class Project(models.Model):
                         'short_description',
                         'project_manager',
                         'number_of_repos',
+                        'number_of_members',
+                        'total_size',
+                        'number_of_issues',
                         'created_date',
                         'modified_date',
                         )
@@ -143,22 +217,26 @@ class Project(models.Model):
 
     def number_of_repos(self):
         """Returns the number of repositories linked to this project"""
-        return self.repo_set.count()
+        return self.repo_count
     number_of_repos.short_description = _("No. Repositories")
     number_of_repos = property(number_of_repos)
     
     def total_size(self):
-        filesize = 0
-        for r in self.repo_set.all():
-            filesize += r.folder_size
-        return filesize
+        """Returns the total size of the repositories linked to this project"""
+        return self.repo_size
     total_size = property(total_size)
     
     def number_of_members(self):
         """Returns the total number of members including the owner"""
-        return self.user_set.count()
+        return self.member_count
     number_of_members.short_description = _("No. Members")
     number_of_members = property(number_of_members)
+
+    def number_of_issues(self):
+        """Returns the number of issues in this project"""
+        return self.issue_count
+    number_of_issues.short_description = _("No. Issues")
+    number_of_issues = property(number_of_issues)
     
     def project_directory(self):
         return os.path.join(Project.project_options.repository_directory, self.project_id)
@@ -169,27 +247,32 @@ class Project(models.Model):
         return len(self.members.filter(id = user.id)) > 0
     
     def get_permissions(self, user):
-        """ Returns an ProjectPermissionSet of the user `user`.
+        """ Returns the Permissions of the user `user`.
         If the user is the owner, he gets all permissions.
         If the user has a permission set in the project, return those.
         If the user doesn't have permissions in the project, return
         the default project ones. If those aren't found, returns a
         permission set with all the permissions set to False.
+
+        The Permissions can be read like a ProjectPermissionSet, as in permissions.view_issues.
+        The member and default permission sets are kept in the cache, and dropped from it
+        whenever the project or one of its permission sets is saved or deleted, so an
+        anonymous user doesn't need a query at all.
         """
         #if the user is the owner of the project, give him all permissions
-        if user.id == self.project_manager.id:
-            permissions = ProjectPermissionSet.objects.get_owner_permission_set(user, self)
-        else:
-            try:
-                #Try to find a permission set for the user
-                permissions = self.projectpermissionset_set.get(user__id=user.id, user_accepted = True, owner_accepted = True)
-            except ProjectPermissionSet.DoesNotExist:
-                #If there's no specific permission set for the user, try to find a default permission set
-                try:
-                    permissions = self.get_default_permissionset()
-                except ProjectPermissionSet.DoesNotExist:
-                    #If even a default one isn't found (although this shouldn't happen), return a restricted permission set
-                    permissions = ProjectPermissionSet.objects.get_null_permission_set(user, self)
+        if user.id == self.project_manager_id:
+            return Permissions.ALL
+        #Try to find a permission set for the user, anonymous users can't have one
+        if user.id is not None:
+            permissions = cached_permissions(self.id, 'user-%s' % user.id,
+                self.projectpermissionset_set.filter(user__id=user.id, user_accepted = True, owner_accepted = True))
+            if permissions is not None:
+                return permissions
+        #If there's no specific permission set for the user, try to find a default permission set
+        permissions = cached_permissions(self.id, 'default', self.projectpermissionset_set.filter(is_default=True))
+        if permissions is None:
+            #If even a default one isn't found (although this shouldn't happen), return no permissions
+            permissions = Permissions.NONE
         return permissions
 
     def _get_members(self):
@@ -233,11 +316,7 @@ class Project(models.Model):
         return not self.get_default_permissionset().view_project
 
     def get_default_permissionset(self):
-        default_permission_list = self.projectpermissionset_set.filter(is_default=True)
-        if len(default_permission_list) == 0:
-            raise ProjectPermissionSet.DoesNotExist
-        else:
-            return default_permission_list[0]
+        return self.projectpermissionset_set.filter(is_default=True)[0:1].get()
 
     def accept_join_request(self, permissionset):
         """
@@ -248,6 +327,7 @@ class Project(models.Model):
         1. The owner_accepted flag is set to True
         2. The permissions are set to the project's default permission set, which the owner
         will later probably want to change
+        The cached permissions of the project are dropped once the new set is saved.
         """
 
         # What's basically achieved here is that the permission set for the aspiring
@@ -262,6 +342,7 @@ class Project(models.Model):
         newpermissionset.owner_accepted = True
         newpermissionset.is_default = False
         newpermissionset.save()
+        invalidate_project_permissions(self.id)
 
     @permalink
     def get_absolute_url(self):
@@ -275,6 +356,11 @@ signals.post_save.connect( create_project_dir, sender=Project )
 signals.post_save.connect( create_hgwebconfig, sender=Project )
 signals.post_save.connect( send_email_to_owner, sender=Project )
 signals.post_delete.connect( delete_project_dir, sender=Project )
+signals.post_save.connect( invalidate_project_permission_cache, sender=Project )
+signals.post_delete.connect( invalidate_project_permission_cache, sender=Project )
+signals.post_save.connect( update_project_counters, sender=Project )
+signals.pre_delete.connect( mark_project_deleting, sender=Project )
+signals.post_delete.connect( unmark_project_deleting, sender=Project )
 
 class ProjectPermissionSetManager(models.Manager):
     """
@@ -282,13 +368,10 @@ class ProjectPermissionSetManager(models.Manager):
     """
     def get_owner_permission_set(self, user, project):
         """
-        Returns a permission set with full permissions for the user `user` in project `project`
+        Returns a permission set with full permissions for the user `user` in project `project`.
+        Project.get_permissions returns Permissions.ALL for the owner instead.
         """
-        return ProjectPermissionSet(is_default=False, user=user, project=project,\
-        view_project = True, edit_project= True, add_members=True, delete_members = True,\
-        add_repos = True, delete_repos = True, edit_repos = True, view_repos = True,\
-        add_issues = True, delete_issues = True, edit_issues = True, view_issues = True, \
-        add_wiki = True, delete_wiki = True, edit_wiki = True, view_wiki = True)
+        return self.from_permissions(Permissions.ALL, user, project)
     
     def get_null_permission_set(self, user, project):
         """
@@ -296,11 +379,15 @@ class ProjectPermissionSetManager(models.Manager):
         Only to be used in case a project doesn't have a default permission set, although that
         normally shouldn't happen
         """
-        return ProjectPermissionSet(is_default=False, user=user, project=project,\
-        view_project = False, edit_project= False, add_members=False, delete_members = False,\
-        add_repos = False, delete_repos = False, edit_repos = False, view_repos = False,\
-        add_issues = False, delete_issues = False, edit_issues = False, view_issues = False, \
-        add_wiki = False, delete_wiki = False, edit_wiki = False, view_wiki = False)
+        return self.from_permissions(Permissions.NONE, user, project)
+
+    def from_permissions(self, permissions, user, project):
+        """
+        Returns an unsaved permission set for the user `user` in project `project` with
+        the boolean fields set from the Permissions `permissions`
+        """
+        fields = dict([(name, name in permissions) for name in PERMISSION_NAMES])
+        return ProjectPermissionSet(is_default=False, user=user, project=project, **fields)
 
 class ProjectPermissionSet(models.Model):
     """
@@ -339,6 +426,11 @@ class ProjectPermissionSet(models.Model):
     view_wiki = models.BooleanField(default=True)
 
     objects = ProjectPermissionSetManager()
+
+    def permissions(self):
+        """The permissions granted by this set as a Permissions"""
+        return Permissions.from_permission_set(self)
+    permissions = property(permissions)
     
     def __unicode__(self):
         if self.is_default:
@@ -352,6 +444,12 @@ class ProjectPermissionSet(models.Model):
     
     class Meta:
         unique_together = ('user','project')
+
+# Dispatchers
+signals.post_save.connect( invalidate_permission_set_cache, sender=ProjectPermissionSet )
+signals.post_delete.connect( invalidate_permission_set_cache, sender=ProjectPermissionSet )
+signals.post_save.connect( update_member_counter, sender=ProjectPermissionSet )
+signals.post_delete.connect( update_member_counter, sender=ProjectPermissionSet )
         
 
 class ProjectNews(models.Model):
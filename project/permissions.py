@@ -0,0 +1,195 @@
+# General Libraries
+import uuid
+# Django Libraries
+from django.conf import settings
+from django.core.cache import cache
+# Project Libraries
+
+# The boolean permissions of ProjectPermissionSet, in the order of their bits.  New
+# permissions must be added at the end, or masks that are already cached change meaning.
+PERMISSION_NAMES = (
+    'view_project', 'edit_project',
+    'add_members', 'delete_members',
+    'add_repos', 'delete_repos', 'edit_repos', 'view_repos',
+    'add_issues', 'delete_issues', 'edit_issues', 'view_issues',
+    'add_wiki', 'delete_wiki', 'edit_wiki', 'view_wiki',
+)
+PERMISSION_BITS = dict([(name, 1 << i) for i, name in enumerate(PERMISSION_NAMES)])
+
+class Permissions(object):
+    """
+    An immutable set of project permissions packed into an integer, one bit for each
+    name in PERMISSION_NAMES.  Checking, comparing, caching and pickling one costs no
+    more than doing the same with an int.
+
+    The permissions can still be read as booleans the way they are on a
+    ProjectPermissionSet, so perms.view_issues, getattr(perms, 'view_issues') and
+    {{ perms.view_issues }} in a template all work.  Sets of permissions can be tested
+    in one go with `required in perms` or perms.issuperset(required).
+    """
+    __slots__ = ('mask',)
+
+    def __init__(self, mask=0):
+        object.__setattr__(self, 'mask', int(mask))
+
+    def from_names(cls, *names):
+        """Returns the Permissions with exactly the permissions `names`"""
+        mask = 0
+        for name in names:
+            mask |= PERMISSION_BITS[name]
+        return cls(mask)
+    from_names = classmethod(from_names)
+
+    def from_permission_set(cls, permission_set):
+        """Returns the Permissions granted by the boolean fields of a ProjectPermissionSet"""
+        return cls.from_names(*[name for name in PERMISSION_NAMES if getattr(permission_set, name)])
+    from_permission_set = classmethod(from_permission_set)
+
+    def names(self):
+        """Returns the names of the permissions granted, in PERMISSION_NAMES order"""
+        return [name for name in PERMISSION_NAMES if self.mask & PERMISSION_BITS[name]]
+
+    def issuperset(self, other):
+        """Returns True if every permission in the Permissions `other` is granted"""
+        return self.mask & other.mask == other.mask
+
+    def __contains__(self, item):
+        if isinstance(item, Permissions):
+            return self.issuperset(item)
+        return bool(self.mask & PERMISSION_BITS[item])
+
+    def __getattr__(self, name):
+        try:
+            return bool(self.mask & PERMISSION_BITS[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return bool(self.mask & PERMISSION_BITS[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Permissions objects are immutable")
+
+    def __or__(self, other):
+        return Permissions(self.mask | other.mask)
+
+    def __and__(self, other):
+        return Permissions(self.mask & other.mask)
+
+    def __eq__(self, other):
+        return isinstance(other, Permissions) and self.mask == other.mask
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __nonzero__(self):
+        return bool(self.mask)
+
+    def __reduce__(self):
+        return (Permissions, (self.mask,))
+
+    def __repr__(self):
+        return '<Permissions: %s>' % ', '.join(self.names())
+
+Permissions.ALL = Permissions((1 << len(PERMISSION_NAMES)) - 1)
+Permissions.NONE = Permissions(0)
+
+# Cached in place of a permission set that doesn't exist, as the cache can't hold None
+NOT_FOUND = -1
+
+def _version_key(project_id):
+    return 'hgfront-perms-version-%s' % project_id
+
+def _timeout():
+    return getattr(settings, 'HGFRONT_PERMISSION_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# Cache backends that aren't shared between processes.  Invalidating a project's permissions
+# would only reach the process that made the change, so nothing is cached with these.
+UNSHARED_CACHE_BACKENDS = ('locmem', 'simple', 'dummy')
+
+def _cache_is_shared():
+    backend = getattr(settings, 'CACHE_BACKEND', 'locmem://').split(':', 1)[0]
+    return backend not in UNSHARED_CACHE_BACKENDS
+
+def permission_cache_key(project_id, name):
+    """
+    Returns the cache key for `name` in the cached permissions of a project.  The keys
+    include a version that invalidate_project_permissions replaces, which drops every
+    cached permission set of the project at once.
+    """
+    version = cache.get(_version_key(project_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(_version_key(project_id), version, _timeout())
+    # Masks are kept apart from the ProjectPermissionSets cached under 'hgfront-perms-'
+    # before, which would otherwise be read back until they expire
+    return 'hgfront-permmask-%s-%s-%s' % (project_id, version, name)
+
+def invalidate_project_permissions(project_id):
+    """Drops every cached permission set of the project"""
+    cache.set(_version_key(project_id), uuid.uuid4().hex, _timeout())
+
+def cached_permissions(project_id, name, queryset):
+    """
+    Returns the Permissions of the first permission set in `queryset`, or None if there
+    isn't one, keeping the mask in the cache under `name` until the project's
+    permissions change.  Nothing is cached unless the cache backend is shared by every process.
+    """
+    if not _cache_is_shared():
+        try:
+            return Permissions.from_permission_set(queryset[0:1].get())
+        except queryset.model.DoesNotExist:
+            return None
+    key = permission_cache_key(project_id, name)
+    mask = cache.get(key)
+    if mask is None:
+        try:
+            mask = Permissions.from_permission_set(queryset[0:1].get()).mask
+        except queryset.model.DoesNotExist:
+            mask = NOT_FOUND
+        cache.set(key, mask, _timeout())
+    if mask == NOT_FOUND:
+        return None
+    return Permissions(mask)
+
+class PermissionResolver(object):
+    """
+    Resolves the permissions of the user making a request on projects, remembering the
+    permission set for each project so it is only looked up once per request however
+    many decorators, views and templates ask for it.  The ProjectPermissions middleware
+    attaches one to every request as request.project_permissions.
+    """
+    def __init__(self, request):
+        self.request = request
+        self._resolved = {}
+
+    def for_project(self, project):
+        """Returns the Permissions of the user on `project`"""
+        if project.id not in self._resolved:
+            self._resolved[project.id] = project.get_permissions(self.request.user)
+        return self._resolved[project.id]
+
+    def has_permissions(self, project, *permissions):
+        """
+        Returns True if the user has every one of `permissions` on `project`, which can
+        be given as names or as a single Permissions
+        """
+        if len(permissions) == 1 and isinstance(permissions[0], Permissions):
+            required = permissions[0]
+        else:
+            required = Permissions.from_names(*permissions)
+        return self.for_project(project).issuperset(required)
+
+def get_resolver(request):
+    """Returns the resolver of `request`, attaching one if the middleware isn't installed"""
+    resolver = getattr(request, 'project_permissions', None)
+    if resolver is None:
+        resolver = request.project_permissions = PermissionResolver(request)
+    return resolver
+
+def get_permissions(request, project):
+    """Returns the permissions of the user making `request` on `project`"""
+    return get_resolver(request).for_project(project)
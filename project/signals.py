@@ -18,6 +18,65 @@ def create_default_permission_set(sender, instance, signal, *args, **kwargs):
         permission_set = ProjectPermissionSet(is_default=True, project=instance, user=None)
         permission_set.save()
 
+def invalidate_project_permission_cache(sender, instance, signal, *args, **kwargs):
+    """
+    Drops the cached permissions of a project when it is saved or deleted
+    """
+    from project.permissions import invalidate_project_permissions
+    invalidate_project_permissions(instance.id)
+
+def invalidate_permission_set_cache(sender, instance, signal, *args, **kwargs):
+    """
+    Drops the cached permissions of the project when one of its permission sets is saved or deleted
+    """
+    from project.permissions import invalidate_project_permissions
+    invalidate_project_permissions(instance.project_id)
+
+# The ids of the projects being deleted in this process.  Deleting a project deletes its
+# repositories, issues and permission sets first, and their counters aren't worth keeping.
+deleting_projects = set()
+
+def mark_project_deleting(sender, instance, signal, *args, **kwargs):
+    """
+    Executed before a project is deleted, so the rows deleted along with it don't
+    recompute its counters
+    """
+    deleting_projects.add(instance.id)
+
+def unmark_project_deleting(sender, instance, signal, *args, **kwargs):
+    deleting_projects.discard(instance.id)
+
+def _update_counters(project_id, counters=None):
+    from project.models import Project
+    if project_id in deleting_projects:
+        return
+    Project.projects.update_counters(project_id, counters)
+
+def update_project_counters(sender, instance, signal, *args, **kwargs):
+    """
+    Recomputes every counter of a project after it is saved, as save() writes back
+    whatever counter values the saved instance had
+    """
+    _update_counters(instance.id)
+
+def update_member_counter(sender, instance, signal, *args, **kwargs):
+    """
+    Recomputes the member count of the project when one of its permission sets changes
+    """
+    _update_counters(instance.project_id, ('member_count',))
+
+def update_repo_counters(sender, instance, signal, *args, **kwargs):
+    """
+    Recomputes the repository count and total size of the project a repository belongs to
+    """
+    _update_counters(instance.local_parent_project_id, ('repo_count', 'repo_size'))
+
+def update_issue_counter(sender, instance, signal, *args, **kwargs):
+    """
+    Recomputes the issue count of the project an issue belongs to
+    """
+    _update_counters(instance.project_id, ('issue_count',))
+
 def create_project_dir(sender, instance, signal, *args, **kwargs):
     """
     Checks to see if path already exists, and if not this is a new project so creates path.
@@ -1,8 +1,11 @@
+import pickle, unittest
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from models import Project, ProjectPermissionSet
+from permissions import PERMISSION_NAMES, Permissions
 from config.models import Setting
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
+from views import PROJECT_PAGE_SIZE
 
 # Put your repo and backups path here before testing until
 # I find a way to get the settings from the normal database
@@ -69,6 +72,26 @@ class ProjectTestCase(HGFTestCase):
         #gets a list of 6 identical contexts. TODO: find out wtf
         self.assertEquals(response.context[0]['project'], expected['project'])
 
+    def test_visible_to_matches_get_permissions(self):
+        """ visible_to should return exactly the projects get_permissions lets each user view """
+        users = list(User.objects.all()) + [AnonymousUser()]
+        for user in users:
+            expected = [p.id for p in Project.projects.all() if p.get_permissions(user).view_project]
+            visible = [p.id for p in Project.projects.visible_to(user)]
+            expected.sort()
+            visible.sort()
+            self.assertEquals(visible, expected, 'visible_to differs for %s' % user)
+
+    def test_project_list_pagination(self):
+        """ The project list should only hold the projects on the requested page """
+        response = self.client.get(reverse('project-list'), {'page': 1})
+        self.assert_(response.status_code == 200)
+        self.assert_(len(response.context[0]['projects']) <= PROJECT_PAGE_SIZE)
+        self.assertEquals(response.context[0]['current_page'], 1)
+        # A page past the end shows the last page rather than failing
+        response = self.client.get(reverse('project-list'), {'page': 1000})
+        self.assert_(response.status_code == 200)
+
 class AnonymousProjectTestCase(ProjectTestCase):
     """ This is like the ProjectTestCase test case only it does the testingd
     with an anonymous user, whereas ProjectTestCase does the tests with a 
@@ -118,3 +141,44 @@ class SecretProjectTestCase(HGFTestCase):
         response = self.client.get(self.project_used.get_absolute_url())
         self.assert_(response.status_code == expected['status_code'])
         self.client.login(username=self.user, password=self.passwords[self.user])
+
+class PermissionsTestCase(unittest.TestCase):
+    """ Tests the Permissions bitmask, which needs no database """
+    def test_from_names(self):
+        perms = Permissions.from_names('view_project', 'view_repos')
+        self.assertEquals(perms.names(), ['view_project', 'view_repos'])
+        self.assert_(perms.view_repos)
+        self.assert_(not perms.edit_repos)
+        self.assert_(perms['view_project'])
+        self.assertEquals(Permissions.from_names(), Permissions.NONE)
+        self.assertEquals(Permissions.from_names(*PERMISSION_NAMES), Permissions.ALL)
+
+    def test_contains(self):
+        perms = Permissions.from_names('view_project', 'view_repos', 'add_repos')
+        self.assert_('view_repos' in perms)
+        self.assert_('delete_repos' not in perms)
+        self.assert_(Permissions.from_names('view_project', 'add_repos') in perms)
+        self.assert_(Permissions.from_names('view_project', 'delete_repos') not in perms)
+        self.assert_(Permissions.NONE in perms)
+        self.assert_(perms in Permissions.ALL)
+
+    def test_combining(self):
+        view = Permissions.from_names('view_project')
+        add = Permissions.from_names('add_repos')
+        self.assertEquals((view | add).names(), ['view_project', 'add_repos'])
+        self.assertEquals(view & add, Permissions.NONE)
+        self.assert_(not Permissions.NONE)
+        self.assert_(view)
+
+    def test_immutable(self):
+        perms = Permissions.from_names('view_project')
+        self.assertRaises(AttributeError, setattr, perms, 'view_project', False)
+        self.assertRaises(AttributeError, setattr, perms, 'mask', 0)
+        self.assertRaises(AttributeError, getattr, perms, 'no_such_permission')
+
+    def test_pickling(self):
+        perms = Permissions.from_names('view_issues', 'edit_wiki')
+        copy = pickle.loads(pickle.dumps(perms, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(copy, perms)
+        self.assertEquals(hash(copy), hash(perms))
+        self.assert_(isinstance(copy, Permissions))
@@ -6,6 +6,7 @@ from time import strftime
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator, InvalidPage
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
@@ -16,6 +17,7 @@ from core.libs.json_libs import json_encode, JsonResponse
 from project.forms import *
 from project.models import Project, ProjectPermissionSet, ProjectNews
 from project.decorators import check_project_permissions
+from project.permissions import get_permissions
 from issue.models import Issue
 from member.models import Member
 
@@ -24,8 +26,32 @@ from django.core.cache import cache
 CACHE_EXPIRES = 5 * 60 # 5 minutes
 # End caching stuff
 
+# The number of projects on each page of the project list
+PROJECT_PAGE_SIZE = 50
+
 def get_project_list(request):
-    projects = [project for project in Project.projects.all() if project.get_permissions(request.user).view_project]
+    """
+    Lists the projects the user may view, PROJECT_PAGE_SIZE at a time.  The page is
+    chosen with the `page` querystring variable.
+    """
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        page_number = 1
+    paginator = Paginator(Project.projects.visible_to(request.user), PROJECT_PAGE_SIZE)
+    try:
+        page = paginator.page(page_number)
+    except InvalidPage:
+        page = paginator.page(paginator.num_pages)
+    projects = page.object_list
+    
+    #generate the list of pages for the template
+    pages = []
+    if paginator.num_pages > 1:
+        for number in paginator.page_range:
+            new_query_dict = request.GET.copy()
+            new_query_dict['page'] = number
+            pages.append((number, new_query_dict.urlencode()))
     project_news = ProjectNews.news_items.filter(frontpage=True, authorised=True).order_by('-pub_date')[:2]
     #user_can_request_to_join = ProjectPermissionSet.objects.filter(project=project, user__id=request.user.id).count()<1 and request.user.is_authenticated() and request.user != project.user_owner
     
@@ -38,6 +64,8 @@ def get_project_list(request):
         {
             'view_title': "All Projects",
             'projects': projects,
+            'pages': pages,
+            'current_page': page.number,
             'project_news': project_news,
             'json_output': json_encode({'projects' : projects,}),
             #'user_can_request_to_join':user_can_request_to_join
@@ -52,7 +80,7 @@ def get_project_details(request, slug):
     #    cache.set(cache_key, project, CACHE_EXPIRES)
 
     project = get_object_or_404(Project.projects.select_related(), project_id=slug)
-    permissions = project.get_permissions(request.user)
+    permissions = get_permissions(request, project)
     
     backups = ProjectBackup.objects.filter(parent_project__exact=project).order_by('-created')
     
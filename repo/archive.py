@@ -0,0 +1,174 @@
+# General Libraries
+import os, time, tarfile, zipfile, tempfile
+from cStringIO import StringIO
+from mercurial.node import hex, short
+# Django Libraries
+from django.conf import settings
+# Project Libraries
+
+# Archive types that can be listed in Repo.archive_types, with the tarfile mode (or
+# None for zip), the file extension and the mime type of each
+ARCHIVE_TYPES = {
+    'bz2': ('w|bz2', '.tar.bz2', 'application/x-bzip2'),
+    'gz': ('w|gz', '.tar.gz', 'application/x-gzip'),
+    'tar': ('w|', '.tar', 'application/x-tar'),
+    'zip': (None, '.zip', 'application/zip'),
+}
+
+# Size of the chunks read back from a cached archive
+CHUNK_SIZE = 64 * 1024
+
+class ChunkBuffer(object):
+    """
+    A write-only file object that holds what has been written to it until it
+    is drained.  The tar and zip writers write into this, and the generators
+    below hand back whatever they have written after each file.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+            self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _archive_files(repository, ctx):
+    """Yields (name, mode, flags, data) for every file in the manifest of `ctx`, one at a time"""
+    manifest = ctx.manifest()
+    files = manifest.keys()
+    files.sort()
+    root = hex(repository.changelog.node(0))
+    yield ('.hg_archival.txt', 0644, '', 'repo: %s\nnode: %s\n' % (root, hex(ctx.node())))
+    for name in files:
+        flags = manifest.flags(name)
+        data = ctx.filectx(name).data()
+        if hasattr(repository, 'wwritedata'):
+            data = repository.wwritedata(name, data)
+        mode = 'x' in flags and 0755 or 0644
+        yield (name, mode, flags, data)
+
+def _tar_chunks(repository, ctx, prefix, tar_mode):
+    buffer = ChunkBuffer()
+    mtime = int(ctx.date()[0])
+    archive = tarfile.open(mode=tar_mode, fileobj=buffer)
+    for name, mode, flags, data in _archive_files(repository, ctx):
+        info = tarfile.TarInfo(prefix + name)
+        info.mtime = mtime
+        info.mode = mode
+        if 'l' in flags:
+            info.type = tarfile.SYMTYPE
+            info.linkname = data
+            archive.addfile(info)
+        else:
+            info.size = len(data)
+            archive.addfile(info, StringIO(data))
+        chunk = buffer.drain()
+        if chunk:
+            yield chunk
+    archive.close()
+    yield buffer.drain()
+
+def _zip_chunks(repository, ctx, prefix):
+    buffer = ChunkBuffer()
+    date_time = time.gmtime(ctx.date()[0])[:6]
+    archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+    for name, mode, flags, data in _archive_files(repository, ctx):
+        info = zipfile.ZipInfo(prefix + name, date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = (mode | 0100000) << 16L
+        archive.writestr(info, data)
+        yield buffer.drain()
+    archive.close()
+    yield buffer.drain()
+
+def archive_chunks(repository, ctx, archive_type, prefix=''):
+    """
+    A generator that builds an archive of the changeset `ctx` and yields it a chunk at a
+    time, reading one file from the repository for each chunk.  Neither the archive nor
+    the manifest's contents are ever held in memory as a whole.
+    """
+    tar_mode = ARCHIVE_TYPES[archive_type][0]
+    if tar_mode is None:
+        return _zip_chunks(repository, ctx, prefix)
+    return _tar_chunks(repository, ctx, prefix, tar_mode)
+
+def archive_cache_path(repo, ctx, archive_type):
+    """
+    Returns where the archive of `ctx` would be cached on disk, or None if archive
+    caching is switched off or `ctx` is not a tagged revision
+    """
+    cache_directory = getattr(settings, 'HGFRONT_ARCHIVE_CACHE_DIR', None)
+    if not cache_directory or not [t for t in ctx.tags() if t != 'tip']:
+        return None
+    return os.path.join(cache_directory, repo.local_parent_project.project_id, repo.directory_name,
+                        hex(ctx.node()) + ARCHIVE_TYPES[archive_type][1])
+
+def file_chunks(path):
+    """Yields the contents of the file at `path` a chunk at a time"""
+    archive = open(path, 'rb')
+    try:
+        while True:
+            chunk = archive.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        archive.close()
+
+def _caching_chunks(chunks, path):
+    """
+    Passes `chunks` through while also writing them to a temporary file, which is moved
+    to `path` once the whole archive has been written.  If the download is abandoned
+    part way the temporary file is thrown away.
+    """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        cache_file = os.fdopen(fd, 'wb')
+    except (IOError, OSError):
+        for chunk in chunks:
+            yield chunk
+        return
+    complete = False
+    try:
+        for chunk in chunks:
+            cache_file.write(chunk)
+            yield chunk
+        complete = True
+    finally:
+        cache_file.close()
+        if complete:
+            os.rename(tmp_path, path)
+        else:
+            os.unlink(tmp_path)
+
+def repo_archive_chunks(repo, changeset, archive_type):
+    """
+    Returns (chunks, filename) for an archive of `changeset` in `repo`.  Tagged
+    revisions are served from, or written to, the archive cache when it is enabled.
+    """
+    repository = repo.get_repository()
+    ctx = repository.changectx(changeset)
+    name = '%s-%s' % (repo.directory_name, short(ctx.node()))
+    filename = name + ARCHIVE_TYPES[archive_type][1]
+    cache_path = archive_cache_path(repo, ctx, archive_type)
+    if cache_path and os.path.isfile(cache_path):
+        return file_chunks(cache_path), filename
+    chunks = archive_chunks(repository, ctx, archive_type, name + '/')
+    if cache_path:
+        chunks = _caching_chunks(chunks, cache_path)
+    return chunks, filename
@@ -0,0 +1,124 @@
+"""
+The jobs run for messages on the repository queues.  These are shared by the pop_queue
+view and the queue worker.
+"""
+# General Libraries
+import datetime, sys, traceback
+from mercurial import hg, ui, commands
+# Django Libraries
+from django.conf import settings
+from django.utils import simplejson
+# Project Libraries
+from project.models import Project
+from repo.models import Repo, Changeset
+from repo.pool import repository_pool
+from repo.queues import get_queue_backend
+
+def load_repo(message):
+    """Returns the Repo a queue message refers to"""
+    data = simplejson.loads(message.message)
+    project = Project.projects.get(project_id__exact=data['local_parent_project'])
+    return Repo.objects.get(directory_name__exact=data['directory_name'], local_parent_project__exact=project)
+
+def clone_repo(repo):
+    """Clones the remote repository into place for a newly created cloned Repo"""
+    heads = repo.fetch_remote_heads()
+    hg.clone(ui.ui(), str(repo.default_path), repo.repo_directory, True)
+    repo.created = True
+    repo.remote_heads = ' '.join(heads)
+    repo.update_folder_size()
+    repo.save()
+
+def working_copy_is_stale(repository):
+    """Returns True if the working copy isn't checked out at the tip, as after a push"""
+    return repository.dirstate.parents()[0] != repository.changelog.tip()
+
+def update_repo(repo):
+    """
+    Pulls and updates from the remote repository.  The remote heads are asked for first,
+    and if they are the ones seen at the last pull the pull is skipped.  If the working
+    copy is at the tip as well nothing else is done and False is returned, so the working
+    copy update, size scan and after-job are all skipped.  Otherwise changesets pushed to
+    this repository since are checked out and counted.
+    """
+    # Taken before pulling, so anything pushed upstream during the pull is seen next time
+    heads = repo.fetch_remote_heads()
+    # The pooled handle is shared with the web threads, so the pull and update run on a
+    # handle of their own and the pooled one is dropped afterwards
+    repository = hg.repository(ui.ui(), repo.repo_directory)
+    if not repo.remote_heads_changed(heads):
+        if not working_copy_is_stale(repository):
+            return False
+        try:
+            hg.update(repository, repository.changelog.tip())
+        finally:
+            repository_pool.discard(repo.repo_directory)
+    else:
+        try:
+            commands.pull(ui.ui(), repository, str(repo.default_path), rev=['tip'], force=True, update=True)
+        finally:
+            repository_pool.discard(repo.repo_directory)
+        repo.remote_heads = ' '.join(heads)
+    repo.update_folder_size()
+    repo.save()
+
+def bundle_repo(repo):
+    """Rebuilds the clone bundle of the repository"""
+    repo.build_clone_bundle()
+    repo.save()
+
+def sync_changesets(repo):
+    """
+    Brings the changeset index of `repo` up to date after a clone or pull.  A failure
+    here shouldn't fail the job, the next sync will pick up where this one stopped, but
+    it is still reported so an index that never catches up doesn't go unnoticed.
+    """
+    try:
+        Changeset.objects.sync(repo)
+    except:
+        print >> sys.stderr, "%s: changeset sync failed" % repo.repo_directory
+        traceback.print_exc(file=sys.stderr)
+
+def after_content_change(repo):
+    """Things to do once new changesets have arrived in a repository"""
+    sync_changesets(repo)
+    try:
+        repo.queue_clone_bundle()
+    except:
+        traceback.print_exc(file=sys.stderr)
+
+# The job for each queue, and what to run after it succeeds and has changed the repository
+JOBS = {
+    'repoclone': (clone_repo, after_content_change),
+    'repoupdate': (update_repo, after_content_change),
+    'repobundle': (bundle_repo, None),
+}
+
+def run_job(queue_name, message):
+    """
+    Runs the job for `message`, which was popped from the queue `queue_name`, and deletes
+    the message once it has succeeded.  Returns True on success.  A job returns False
+    when it found nothing to do, in which case the after-job isn't run.  If the job fails the
+    message is retried after a backoff, or dead lettered once it has failed too often.
+    """
+    job, after = JOBS[queue_name]
+    if message.attempts > getattr(settings, 'HGFRONT_QUEUE_MAX_ATTEMPTS', 5):
+        # The job has been popped too often without ever reporting back, it keeps
+        # killing whatever runs it
+        get_queue_backend().dead_letter(message)
+        return False
+    try:
+        repo = load_repo(message)
+        changed = job(repo) is not False
+        get_queue_backend().complete(message)
+        if changed:
+            # Only the modification date, saving the project would run its post_save
+            # handlers, which mail the owner and rewrite hgweb.config
+            Project.projects.filter(id=repo.local_parent_project_id).update(modified_date=datetime.datetime.now())
+    except:
+        traceback.print_exc(file=sys.stderr)
+        get_queue_backend().fail(message)
+        return False
+    if after and changed:
+        after(repo)
+    return True
@@ -6,9 +6,12 @@ from django.dispatch import dispatcher
 def create_queues(app, created_models, verbosity, **kwargs):
     """This creates the initial queues that mercural manager works with"""
     from repo.models import Queue
+    from repo.queues import get_queue_backend
     if Queue in created_models:
-        Queue.objects.get_or_create(name='repoclone')
-        Queue.objects.get_or_create(name='repoupdate')
+        backend = get_queue_backend()
+        backend.create_queue('repoclone')
+        backend.create_queue('repoupdate')
+        backend.create_queue('repobundle')
         
 # Dispatchers       
 signals.post_syncdb.connect(create_queues)
\ No newline at end of file
@@ -0,0 +1,27 @@
+# General Libraries
+import time
+from optparse import make_option
+# Django Libraries
+from django.core.management.base import BaseCommand
+# Project Libraries
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store', type='int', dest='loop', default=0,
+            help='Keep running, checking for due repositories every this many seconds.'),
+    )
+    help = 'Queues an update for every cloned repository whose default path has new changesets.'
+
+    def handle(self, *args, **options):
+        from repo.mirror import schedule_mirrors
+        verbosity = int(options.get('verbosity', 1))
+        interval = options.get('loop')
+        
+        while True:
+            queued = schedule_mirrors(verbosity)
+            if verbosity > 0:
+                for repo in queued:
+                    print "%s: update queued" % repo.repo_directory
+            if not interval:
+                break
+            time.sleep(interval)
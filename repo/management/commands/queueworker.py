@@ -0,0 +1,40 @@
+# General Libraries
+from optparse import make_option
+# Django Libraries
+from django.core.management.base import BaseCommand, CommandError
+# Project Libraries
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', action='append', dest='concurrency', default=[],
+            help='How many jobs to run at once from a queue, as queue=number. Can be given more than once.'),
+        make_option('--poll-interval', action='store', type='int', dest='poll_interval', default=5,
+            help='Seconds to wait between polls of the queues.'),
+        make_option('--expire', action='store', type='int', dest='expire', default=5,
+            help='Minutes a popped message stays invisible before it is extended.'),
+    )
+    help = 'Runs the repository queue jobs in a pool of child processes until stopped.'
+    args = '[queue ...]'
+
+    def handle(self, *args, **options):
+        from repo.jobs import JOBS
+        from repo.worker import QueueWorker, default_concurrency
+        
+        concurrency = default_concurrency()
+        for option in options.get('concurrency'):
+            try:
+                name, number = option.split('=', 1)
+                concurrency[name] = int(number)
+            except ValueError:
+                raise CommandError("Invalid concurrency: %s" % option)
+        if args:
+            concurrency = dict([(name, concurrency.get(name, 1)) for name in args])
+        for name in concurrency:
+            if name not in JOBS:
+                raise CommandError("There is no job for the queue: %s" % name)
+        
+        worker = QueueWorker(concurrency,
+                             poll_interval=options.get('poll_interval'),
+                             expire_interval=options.get('expire'),
+                             verbosity=int(options.get('verbosity', 1)))
+        worker.run()
@@ -0,0 +1,27 @@
+# General Libraries
+import time
+from optparse import make_option
+# Django Libraries
+from django.core.management.base import BaseCommand
+# Project Libraries
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store', type='int', dest='loop', default=0,
+            help='Keep running, reaping every this many seconds.'),
+    )
+    help = 'Makes queue messages whose visibility timeout has expired visible again.'
+
+    def handle(self, *args, **options):
+        from repo.queues import get_queue_backend
+        verbosity = int(options.get('verbosity', 1))
+        interval = options.get('loop')
+        
+        while True:
+            reaped = get_queue_backend().reap()
+            if verbosity > 0:
+                for name, count in reaped.items():
+                    print "%s: %s expired messages made visible" % (name, count)
+            if not interval:
+                break
+            time.sleep(interval)
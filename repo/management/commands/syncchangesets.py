@@ -0,0 +1,39 @@
+# General Libraries
+from optparse import make_option
+# Django Libraries
+from django.core.management.base import BaseCommand, CommandError
+# Project Libraries
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Throw away the existing index and import every changeset again.'),
+    )
+    help = 'Imports new changesets from the repositories into the changeset index.'
+    args = '[project_id/directory_name ...]'
+
+    def handle(self, *args, **options):
+        from repo.models import Repo, Changeset
+        verbosity = int(options.get('verbosity', 1))
+        
+        if args:
+            repos = []
+            for arg in args:
+                try:
+                    project_id, directory_name = arg.split('/', 1)
+                    repos.append(Repo.objects.get(local_parent_project__project_id__exact=project_id, directory_name__exact=directory_name))
+                except (ValueError, Repo.DoesNotExist):
+                    raise CommandError("Unknown repository: %s" % arg)
+        else:
+            repos = Repo.objects.filter(created=True)
+        
+        for repo in repos:
+            if options.get('rebuild'):
+                Changeset.objects.filter(repo=repo).delete()
+            try:
+                added = Changeset.objects.sync(repo)
+            except Exception, e:
+                print "Failed to sync %s: %s" % (repo.repo_directory, e)
+                continue
+            if verbosity > 0:
+                print "%s: %s new changesets" % (repo.repo_directory, added)
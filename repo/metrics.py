@@ -0,0 +1,85 @@
+"""
+Queue metrics for capacity planning, worked out from the messages in each queue and the
+recent job timings kept by the queue backend
+"""
+# General Libraries
+import datetime, math
+# Django Libraries
+from django.conf import settings
+# Project Libraries
+from repo.queues import get_queue_backend
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+def percentile(values, quantile):
+    """Returns the nearest-rank percentile of the sorted list `values`"""
+    if not values:
+        return None
+    # Rounded first, so float noise such as 0.07 * 100 = 7.000000000000001 doesn't go up a rank
+    index = int(math.ceil(round(quantile * len(values), 9))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+def seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+def queue_metrics():
+    """Returns a list with a dictionary of metrics for each queue"""
+    backend = get_queue_backend()
+    window = getattr(settings, 'HGFRONT_QUEUE_METRICS_WINDOW', 3600)
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(seconds=window)
+    result = []
+    for name in backend.queue_names():
+        stats = backend.stats(name, cutoff)
+        durations = stats['durations']
+        result.append({
+            'queue': name,
+            'visible': stats['visible'],
+            'in_flight': stats['in_flight'],
+            'oldest_age': stats['oldest'] and seconds(now - stats['oldest']) or 0,
+            'enqueued_total': stats['enqueued_total'],
+            'completed_total': stats['completed_total'],
+            'failed_total': stats['failed_total'],
+            'window': window,
+            'enqueue_rate': stats['enqueued'] / float(window),
+            'completion_rate': len(durations) / float(window),
+            'failure_rate': stats['failed'] / float(window),
+            'duration_count': len(durations),
+            'duration_sum': sum(durations),
+            'duration_percentiles': dict([(str(quantile), percentile(durations, quantile)) for quantile in QUANTILES]),
+        })
+    return result
+
+def prometheus_text(metrics):
+    """Formats the result of queue_metrics in the Prometheus text exposition format"""
+    lines = []
+    def metric(name, metric_type, help, samples):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for suffix, labels, value in samples:
+            if value is None:
+                continue
+            label_text = ','.join(['%s="%s"' % label for label in labels])
+            lines.append('%s%s{%s} %s' % (name, suffix, label_text, value))
+
+    metric('hgfront_queue_messages', 'gauge', 'Messages in the queue by state.',
+           [('', (('queue', m['queue']), ('state', state)), m[state]) for m in metrics for state in ('visible', 'in_flight')])
+    metric('hgfront_queue_oldest_message_age_seconds', 'gauge', 'Age of the oldest visible message.',
+           [('', (('queue', m['queue']),), m['oldest_age']) for m in metrics])
+    metric('hgfront_queue_enqueued_total', 'counter', 'Messages added to the queue.',
+           [('', (('queue', m['queue']),), m['enqueued_total']) for m in metrics])
+    metric('hgfront_queue_completed_total', 'counter', 'Jobs completed.',
+           [('', (('queue', m['queue']),), m['completed_total']) for m in metrics])
+    metric('hgfront_queue_failed_total', 'counter', 'Job attempts that failed.',
+           [('', (('queue', m['queue']),), m['failed_total']) for m in metrics])
+    # The timings only cover the metrics window, so their totals can go down as old jobs
+    # drop out of it.  They are gauges rather than the _sum and _count of a summary,
+    # which Prometheus expects to be counters.
+    metric('hgfront_queue_job_duration_quantile_seconds', 'gauge', 'Duration quantiles of the jobs completed in the metrics window.',
+           [('', (('queue', m['queue']), ('quantile', str(quantile))), m['duration_percentiles'][str(quantile)])
+            for m in metrics for quantile in QUANTILES])
+    metric('hgfront_queue_window_job_duration_seconds', 'gauge', 'Total duration of the jobs completed in the metrics window.',
+           [('', (('queue', m['queue']),), m['duration_sum']) for m in metrics])
+    metric('hgfront_queue_window_jobs_completed', 'gauge', 'Jobs completed in the metrics window.',
+           [('', (('queue', m['queue']),), m['duration_count']) for m in metrics])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,54 @@
+"""
+Keeps cloned repositories in step with the repositories they were cloned from, by
+queueing a repoupdate job for each one every mirror_interval minutes
+"""
+# General Libraries
+import datetime, random, sys
+# Django Libraries
+from django.conf import settings
+from django.db.models import Q
+# Project Libraries
+from repo.models import Repo
+
+def next_check(interval, now, first=False):
+    """
+    Returns when a repository mirrored every `interval` minutes should next be checked.
+    The first check lands anywhere in the interval, later ones are pushed back by up to
+    HGFRONT_MIRROR_JITTER of the interval, so repositories created or scheduled together
+    drift apart instead of all pulling at once.
+    """
+    if first:
+        delay = random.uniform(0, interval)
+    else:
+        delay = interval * (1 + random.uniform(0, getattr(settings, 'HGFRONT_MIRROR_JITTER', 0.1)))
+    return now + datetime.timedelta(minutes=delay)
+
+def schedule_mirrors(verbosity=0):
+    """
+    Queues a repoupdate job for every cloned repository that is due a check and whose
+    default path has heads it hasn't pulled yet.  Returns the list of repositories queued.
+    """
+    now = datetime.datetime.now()
+    queued = []
+    due = Repo.objects.filter(creation_method='Clone', created=True)
+    due = due.filter(Q(next_mirror__isnull=True) | Q(next_mirror__lte=now))
+    due = due.filter(Q(mirror_interval__isnull=True) | Q(mirror_interval__gt=0))
+    for repo in due.select_related():
+        interval = repo.get_mirror_interval()
+        if not interval:
+            continue
+        first = repo.next_mirror is None
+        Repo.objects.filter(pk=repo.pk).update(next_mirror=next_check(interval, now, first))
+        if first:
+            continue
+        try:
+            changed = repo.remote_heads_changed(repo.fetch_remote_heads())
+        except Exception, e:
+            # Let the job try, so a broken default path shows up in the dead letter queue
+            if verbosity > 0:
+                print >> sys.stderr, "%s: could not read remote heads: %s" % (repo.repo_directory, e)
+            changed = True
+        if changed:
+            repo.queue_job('repoupdate')
+            queued.append(repo)
+    return queued
@@ -1,20 +1,75 @@
 # General Libraries
-import time, datetime, sys, os, shutil
+import time, datetime, sys, os, shutil, md5, uuid
 from mercurial.cmdutil import revrange, show_changeset
-from mercurial.node import nullid
+from mercurial.node import nullid, hex
+from mercurial import changegroup, hg, ui
 from mercurial.hgweb import common
 # Django Libraries
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
 from django.db.models import permalink, signals
 from django.dispatch import dispatcher
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
 from django.utils.translation import gettext_lazy as _
 # Project Libraries
 from core.configs import RepoOptions
 from repo import signals as hgsignals
+from repo.notify import queue_notifier
+from repo.queues import get_queue_backend
+from repo.queues.base import DEAD_LETTER_SUFFIX, coalesced_requeues, retry_delay, should_dead_letter
+from repo.pool import repository_pool
+from repo.size import calculate_repo_size
 from repo.signals import *
-from project.models import Project
+from project.models import Project, ProjectPermissionSet
+from project.signals import update_repo_counters
+
+def metadata_text(value):
+    """
+    Returns changeset metadata, which mercurial keeps as byte strings, as unicode so it
+    can go into templates and json_encode.  Bytes that aren't UTF-8 are replaced.
+    """
+    return force_unicode(value, errors='replace')
+
+class ChangesetSnapshot(object):
+    """
+    An immutable record of a single changeset, built in one pass over the changeset
+    context by Repo.changeset_snapshot.  It holds only plain python values so it can
+    be pickled and put in the cache.
+    """
+    fields = ('id', 'node', 'number', 'user', 'date', 'description', 'files',
+              'branch', 'parents', 'children', 'tags', 'branches')
+
+    def __init__(self, **kwargs):
+        for field in self.fields:
+            self.__dict__[field] = kwargs.get(field)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ChangesetSnapshot objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ChangesetSnapshot objects are immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, ChangesetSnapshot) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return self.id
+
+    def to_dict(self):
+        """Returns the snapshot as a dictionary, for use with json_encode"""
+        ret = {}
+        for field in self.fields:
+            value = getattr(self, field)
+            if isinstance(value, tuple):
+                value = list(value)
+            ret[field] = value
+        return ret
 
 class Repo(models.Model):
     
@@ -42,6 +97,8 @@ class Repo(models.Model):
     allow_anon_pull=models.BooleanField(_('allow anonymous pull'), default=True, help_text=_('this sets the repository so anyone can clone or pull from it'))
     # allow_anon_push: Allow anonymous push on the repo
     allow_anon_push=models.BooleanField(_('allow anonymous push'), default=False, help_text=_('this sets the repository so anyone can push and commit to it'))
+    # allow_stream_clone: Allow clients to clone the raw store files uncompressed
+    allow_stream_clone=models.BooleanField(_('allow uncompressed clone'), default=False, help_text=_('this lets clients on a fast network clone the repository uncompressed with hg clone --uncompressed'))
     # hgweb_style: The style to apply to the hgweb application
     hgweb_style=models.CharField(_('hgweb style'),max_length=50,choices=AVAILABLE_STYLES, help_text=_('the style to show in the project/repo hgweb'))
     # archive_types: The archive types to offer, stored as a string "bz2|tar|zip", "tar|zip", etc
@@ -54,6 +111,14 @@ class Repo(models.Model):
     local_modified_date=models.DateTimeField(_('local modification date'), auto_now=True, editable=False, help_text=_('the date this repository was last locally updated'))
     # folder_size: The total size of the repo folder
     folder_size=models.IntegerField(_('folder size'), default=0, help_text=_('this is the local size of the repository on the file system'))
+    # clone_bundle_rev: The tip revision the pre-generated clone bundle was built at
+    clone_bundle_rev=models.IntegerField(_('clone bundle revision'), null=True, blank=True, editable=False, help_text=_('the revision the clone bundle of this repository was last built at'))
+    # mirror_interval: How often a cloned repo pulls from its default path, None for HGFRONT_MIRROR_INTERVAL
+    mirror_interval=models.PositiveIntegerField(_('mirror interval'), null=True, blank=True, help_text=_('how often in minutes a cloned repository pulls from its default path, 0 to never pull automatically'))
+    # next_mirror: When the mirror scheduler next checks the default path for changes
+    next_mirror=models.DateTimeField(_('next mirror'), null=True, blank=True, editable=False, help_text=_('when the repository is next checked for new changesets'))
+    # remote_heads: The heads of the default path as of the last successful pull
+    remote_heads=models.TextField(_('remote heads'), null=True, blank=True, editable=False, help_text=_('the heads of the default path when the repository last pulled from it'))
 
     
     def __unicode__(self):
@@ -81,6 +146,11 @@ class Repo(models.Model):
     repo_directory.short_description = _("Repository Location")
     repo_directory = property(repo_directory)
 
+    def allowed_archive_types(self):
+        """Returns the list of archive types stored in archive_types"""
+        return [t for t in (self.archive_types or '').split('|') if t]
+    allowed_archive_types = property(allowed_archive_types)
+
     def create_hgrc(self):
         """This function outputs a hgrc file within a repo's .hg directory, for use with hgweb"""
         repo = self
@@ -93,73 +163,275 @@ class Repo(models.Model):
         hgrc.write('description = %s\n' % repo.description)
         hgrc.write('contact = %s <%s>\n' % (c.username, c.email))
         
-        a = repo.archive_types.split
+        a = repo.allowed_archive_types
         o = 'allow_archive = '
         for x in a:
             o += (x + ' ')
         hgrc.write(o + '\n\n')
+        hgrc.write('[server]\n')
+        hgrc.write('uncompressed = %s\n\n' % repo.allow_stream_clone)
 #    hgrc.write('[extensions]\n')
 #    for e in repo.active_extensions.all():
 #        hgrc.write('hgext.%s = \n' % e.short_name)
         hgrc.close()
         return True
     
+    def get_repository(self):
+        """Returns the mercurial repository object for this repo from the process-wide pool"""
+        return repository_pool.get(self.repo_directory)
+
+    def get_branches_and_tags(self, repository=None):
+        """
+        Returns the sorted list of branch names and the tag map of the repository.
+        Both are stored in the cache under the repository directory and the current
+        tip, so they are only worked out again once the tip has moved.
+        """
+        if repository is None:
+            repository = self.get_repository()
+        cache_key = 'hgfront-repo-refs-%s-%s' % (
+            md5.new(self.repo_directory).hexdigest(), hex(repository.changelog.tip()))
+        refs = cache.get(cache_key)
+        if refs is None:
+            branches = repository.branchtags().keys()
+            branches.sort()
+            refs = (branches, repository.tags())
+            cache.set(cache_key, refs, getattr(settings, 'HGFRONT_REPO_CACHE_TIMEOUT', 24 * 60 * 60))
+        return refs
+
     def get_branches(self):
-        u = ui.ui()  # get a ui object
         try:
-            r = hg.repository(u, self.repo_directory)
-            b = r.branchtags() # get a repo object for the current directory
-            branches = b.keys()
-            branches.sort()
+            branches = list(self.get_branches_and_tags()[0])
         except:
             branches = []
         return branches
         
     
     def get_changeset_number(self, changeset='tip'):
-        u = ui.ui()
         try:
-            repository = hg.repository(u, self.repo_directory)
+            repository = self.get_repository()
             changeset = repository.changectx(changeset).rev()
         except:
             changeset = []
         return changeset
         
     def get_changeset(self, changeset="tip"):
-        u = ui.ui()  # get a ui object
         try:
-            repository = hg.repository(u, self.repo_directory) # get a repo object for the current directory
+            repository = self.get_repository() # get a repo object for the current directory
             changeset = repository.changectx(changeset) # get a context object for the "tip" revision
             return changeset
         except:
             return []
         
     def get_previous_changeset(self, changeset="tip"):
-        u = ui.ui()  # get a ui object
         try:
-            repository = hg.repository(u, self.repo_directory) # get a repo object for the current directory
+            repository = self.get_repository() # get a repo object for the current directory
             changesets = repository.changectx(changeset).parents() # get a context object for the "tip" revision
             return [str(changeset) for changeset in changesets if changeset.node() != nullid]
         except:
             return []
         
     def get_next_changeset(self, changeset="tip"):
-        u = ui.ui()  # get a ui object
         try:
-            repository = hg.repository(u, self.repo_directory) # get a repo object for the current directory
+            repository = self.get_repository() # get a repo object for the current directory
             changesets = repository.changectx(changeset).children() # get a context object for the "tip" revision
             return [str(changeset) for changeset in changesets if changeset.node() != nullid]
         except:
             return []
         
+    def changeset_snapshot(self, changeset="tip"):
+        """
+        Resolves `changeset` once and returns a ChangesetSnapshot with its id, number,
+        author, notes, files, parents and children, along with the repository's tags
+        and branches.  Returns None if the repository or changeset can't be read.
+        """
+        try:
+            repository = self.get_repository()
+            ctx = repository.changectx(changeset)
+            branches, tags = self.get_branches_and_tags(repository)
+            tags = tags.keys()
+            tags.sort()
+            return ChangesetSnapshot(
+                id = str(ctx),
+                node = hex(ctx.node()),
+                number = ctx.rev(),
+                user = metadata_text(ctx.user()),
+                date = tuple(ctx.date()),
+                description = metadata_text(ctx.description()),
+                files = tuple([metadata_text(f) for f in ctx.files()]),
+                branch = metadata_text(ctx.branch()),
+                parents = tuple([str(c) for c in ctx.parents() if c.node() != nullid]),
+                children = tuple([str(c) for c in ctx.children() if c.node() != nullid]),
+                tags = tuple([metadata_text(t) for t in tags]),
+                branches = tuple([metadata_text(b) for b in branches]),
+            )
+        except:
+            return None
+
+    def changelog_entries(self, before=None):
+        """
+        A generator that walks the changelog from the newest revision backwards, yielding
+        a dictionary for each changeset.  If `before` is given only revisions lower than
+        it are returned.  Changesets are only read as they are asked for, so taking the
+        first page of a large history costs the same as taking the first page of a small one.
+        """
+        repository = self.get_repository()
+        rev = changelog_length(repository) - 1
+        if before is not None:
+            rev = min(rev, before - 1)
+        while rev >= 0:
+            ctx = repository.changectx(rev)
+            yield {
+                'rev': rev,
+                'id': str(ctx),
+                'node': hex(ctx.node()),
+                'user': metadata_text(ctx.user()),
+                'date': datetime.datetime.fromtimestamp(ctx.date()[0]),
+                'branch': metadata_text(ctx.branch()),
+                'description': metadata_text(ctx.description()),
+            }
+            rev -= 1
+
     def get_tags(self):
-        u = ui.ui()  # get a ui object
         try:
-            r = hg.repository(u, self.repo_directory) # get a repo object for the current directory
-            return r.tags()
+            return dict(self.get_branches_and_tags()[1])
         except:
             return []
         
+    def clone_bundle_path(self):
+        """The location of the pre-generated clone bundle, next to the repository"""
+        try:
+            return str(os.path.join(Project.project_options.repository_directory, self.local_parent_project.project_id, self.directory_name + '.hg'))
+        except:
+            return False
+    clone_bundle_path = property(clone_bundle_path)
+
+    def public_clone_bundle_path(self):
+        """
+        Where the clone bundle is published for the web server to send as a static file,
+        under HGFRONT_CLONE_BUNDLE_DIR, or None if bundles aren't published
+        """
+        bundle_directory = getattr(settings, 'HGFRONT_CLONE_BUNDLE_DIR', None)
+        if not bundle_directory:
+            return None
+        return str(os.path.join(bundle_directory, self.local_parent_project.project_id, self.directory_name + '.hg'))
+    public_clone_bundle_path = property(public_clone_bundle_path)
+
+    def clone_bundle_is_public(self):
+        """Returns True if anyone, logged in or not, may pull the repository and so its bundle"""
+        from django.contrib.auth.models import AnonymousUser
+        from repo.protocol import can_pull
+        return bool(can_pull(self, AnonymousUser()))
+
+    def publish_clone_bundle(self):
+        """
+        Puts a copy of the clone bundle in HGFRONT_CLONE_BUNDLE_DIR if anyone may pull
+        the repository, and takes it out of there if not.  Only public bundles are ever
+        in that directory, so it can be served as it is.
+        """
+        public_path = self.public_clone_bundle_path
+        if public_path is None:
+            return False
+        if not self.clone_bundle_is_public() or not os.path.isfile(self.clone_bundle_path):
+            if os.path.exists(public_path):
+                os.unlink(public_path)
+            return False
+        directory = os.path.dirname(public_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = public_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        try:
+            os.link(self.clone_bundle_path, tmp_path)
+        except (AttributeError, OSError):
+            shutil.copyfile(self.clone_bundle_path, tmp_path)
+        os.rename(tmp_path, public_path)
+        return True
+
+    def clone_bundle_is_stale(self):
+        """
+        Returns True if there is no clone bundle, or the tip has moved on by more than
+        HGFRONT_CLONE_BUNDLE_THRESHOLD changesets since it was built
+        """
+        if self.clone_bundle_rev is None or not os.path.isfile(self.clone_bundle_path):
+            return True
+        threshold = getattr(settings, 'HGFRONT_CLONE_BUNDLE_THRESHOLD', 100)
+        tip = changelog_length(self.get_repository()) - 1
+        return tip - self.clone_bundle_rev > threshold
+
+    def build_clone_bundle(self):
+        """
+        Writes a bundle of every changeset up to the current tip to clone_bundle_path,
+        replacing the previous bundle only once the new one is complete
+        """
+        repository = self.get_repository()
+        tip = changelog_length(repository) - 1
+        if tip < 0:
+            return False
+        tmp_path = self.clone_bundle_path + '.tmp'
+        try:
+            cg = repository.changegroupsubset([nullid], [repository.changelog.node(tip)], 'bundle')
+            changegroup.writebundle(cg, tmp_path, 'HG10BZ')
+            os.rename(tmp_path, self.clone_bundle_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.clone_bundle_rev = tip
+        return True
+
+    def queue_job(self, queue_name):
+        """
+        Queues a job for this repository on the queue `queue_name`.  Jobs are coalesced on
+        the repository, so if one is already waiting in the queue no new message is added.
+        Returns the message and whether it was newly created.
+        """
+        message = simplejson.dumps({
+            'directory_name': self.directory_name,
+            'local_parent_project': self.local_parent_project.project_id,
+        })
+        return get_queue_backend().push(queue_name, message, key='%s/%s' % (self.local_parent_project.project_id, self.directory_name))
+
+    def queue_clone_bundle(self):
+        """Queues a rebuild of the clone bundle if the current one is stale"""
+        if not self.created or not self.clone_bundle_is_stale():
+            return False
+        return self.queue_job('repobundle')[1]
+
+    def get_mirror_interval(self):
+        """Returns how many minutes apart this repository is mirrored, 0 if it isn't"""
+        if not self.is_cloned:
+            return 0
+        if self.mirror_interval is None:
+            return getattr(settings, 'HGFRONT_MIRROR_INTERVAL', 60)
+        return self.mirror_interval
+
+    def fetch_remote_heads(self):
+        """
+        Asks the default path for its heads, which is a single request for a remote
+        repository.  Returns the sorted list of hex node ids.
+        """
+        remote = hg.repository(ui.ui(), str(self.default_path))
+        heads = map(hex, remote.heads())
+        heads.sort()
+        return heads
+
+    def remote_heads_changed(self, heads):
+        """Returns True if `heads` differs from the heads seen at the last pull"""
+        return ' '.join(heads) != (self.remote_heads or '')
+
+    def update_folder_size(self, full=False):
+        """
+        Recalculates folder_size from the repository on disk.  This only rescans what has
+        changed since the last calculation, but should still only be called when the
+        content of the repository has changed, not on every save.
+        """
+        try:
+            self.folder_size = calculate_repo_size(self.repo_directory, full)
+        except OSError:
+            pass
+        return self.folder_size
+
     def last_update(self):
         try:
             last_update = common.get_mtime(self.repo_directory)
@@ -171,8 +443,9 @@ class Repo(models.Model):
     class Admin:
         fields = (
                   ('Repository Creation', {'fields': ('creation_method', 'created', 'directory_name', 'display_name', 'default_path', 'description', 'local_parent_project', )}),
-                  ('Repository Access', {'fields': ('allow_anon_pull', 'allow_anon_push', 'local_manager', 'local_members',)}),
+                  ('Repository Access', {'fields': ('allow_anon_pull', 'allow_anon_push', 'allow_stream_clone', 'local_manager', 'local_members',)}),
                   ('Archive Information', {'fields': ('archive_types', 'hgweb_style')}),
+                  ('Mirroring', {'fields': ('mirror_interval',)}),
                   #('Active Extentions', {'fields': ('active_extensions',)}),
                   ('Date information', {'fields': ('local_creation_date', 'local_modified_date')}),
         )
@@ -189,22 +462,256 @@ class Repo(models.Model):
 
     repo_options = RepoOptions()
 
-signals.pre_save.connect( get_repo_size, sender=Repo )    
 signals.post_delete.connect( delete_repo, sender=Repo )
+signals.post_save.connect( publish_clone_bundle, sender=Repo )
+signals.post_delete.connect( unpublish_clone_bundle, sender=Repo )
+signals.post_save.connect( publish_project_clone_bundles, sender=ProjectPermissionSet )
+signals.post_delete.connect( publish_project_clone_bundles, sender=ProjectPermissionSet )
+signals.post_save.connect( update_repo_counters, sender=Repo )
+signals.post_delete.connect( update_repo_counters, sender=Repo )
+
+def changelog_length(repository):
+    """Returns the number of revisions in the changelog of `repository`"""
+    changelog = repository.changelog
+    if hasattr(changelog, 'count'):
+        return changelog.count()
+    return len(changelog)
+
+class ChangesetManager(models.Manager):
+    """
+    Manager class for Changeset.
+    """
+    # Number of changesets written between commits when syncing
+    sync_batch_size = 500
+
+    def latest_for_repo(self, repo):
+        """Returns the highest indexed changeset of `repo`, or None if nothing is indexed yet"""
+        try:
+            return self.filter(repo=repo).order_by('-rev')[0:1].get()
+        except Changeset.DoesNotExist:
+            return None
+
+    def sync(self, repo):
+        """
+        Imports the changesets of `repo` that are newer than the last indexed revision
+        and returns the number of changesets added.  If the last indexed revision no
+        longer matches the repository (after a strip or rollback) the index for that
+        repo is thrown away and rebuilt.
+        """
+        from django.db import transaction
+        repository = repo.get_repository()
+        changelog = repository.changelog
+        count = changelog_length(repository)
+        
+        latest = self.latest_for_repo(repo)
+        start = 0
+        if latest is not None:
+            if latest.rev < count and hex(changelog.node(latest.rev)) == latest.node:
+                start = latest.rev + 1
+            else:
+                self.filter(repo=repo).delete()
+        if start >= count:
+            return 0
+        
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            try:
+                for rev in xrange(start, count):
+                    ctx = repository.changectx(rev)
+                    parents = [hex(p.node()) for p in ctx.parents() if p.node() != nullid]
+                    Changeset(
+                        repo = repo,
+                        node = hex(ctx.node()),
+                        rev = rev,
+                        author = ctx.user(),
+                        date = datetime.datetime.fromtimestamp(ctx.date()[0]),
+                        branch = ctx.branch(),
+                        description = ctx.description(),
+                        first_parent = parents and parents[0] or '',
+                        second_parent = len(parents) > 1 and parents[1] or '',
+                    ).save()
+                    if (rev - start + 1) % self.sync_batch_size == 0:
+                        transaction.commit()
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            transaction.leave_transaction_management()
+        return count - start
+
+class Changeset(models.Model):
+    """
+    A changeset represents a single entry in the changelog of a repository, mirrored into
+    the database so that logs and stats can be served without reading the changelog
+    """
+    # repo: The repository the changeset belongs to
+    repo=models.ForeignKey(Repo, verbose_name=_('repository'))
+    # node: The full hex id of the changeset
+    node=models.CharField(_('node'), max_length=40, db_index=True)
+    # rev: The local revision number of the changeset
+    rev=models.IntegerField(_('revision'), db_index=True)
+    # author: The committer of the changeset
+    author=models.CharField(_('author'), max_length=255, db_index=True)
+    # date: The date the changeset was committed
+    date=models.DateTimeField(_('date'), db_index=True)
+    # branch: The named branch the changeset was committed on
+    branch=models.CharField(_('branch'), max_length=255, default='default', db_index=True)
+    # description: The commit message
+    description=models.TextField(_('description'), blank=True)
+    # first_parent: The hex id of the first parent, blank for the root changeset
+    first_parent=models.CharField(_('first parent'), max_length=40, blank=True)
+    # second_parent: The hex id of the second parent, blank unless this is a merge
+    second_parent=models.CharField(_('second parent'), max_length=40, blank=True)
+    
+    objects = ChangesetManager()
+    
+    def __unicode__(self):
+        return u"%s:%s" % (self.rev, self.node[:12])
+    
+    def parents(self):
+        """Returns the hex ids of the parents of this changeset"""
+        return [p for p in (self.first_parent, self.second_parent) if p]
+    parents = property(parents)
+    
+    class Admin:
+        list_display = ('rev', 'node', 'repo', 'author', 'branch', 'date',)
+        list_filter = ['repo', 'branch',]
+        search_fields = ['node', 'author', 'description',]
+        date_hierarchy = 'date'
     
+    class Meta:
+        unique_together = (('repo', 'rev'), ('repo', 'node'),)
+        ordering = ['-rev',]
+        verbose_name = _('changeset')
+        verbose_name_plural = _('changesets')
+    
+class QueueManager(models.Manager):
+    def increment(self, queue_id, counter):
+        """Adds one to the counter column `counter` of the queue, in the database"""
+        from django.db import connection, transaction
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+        cursor.execute("UPDATE %s SET %s = %s + 1 WHERE id=%%s" % \
+                       (qn(self.model._meta.db_table), qn(counter), qn(counter)), [queue_id])
+        transaction.commit_unless_managed()
+
 class Queue(models.Model):
     """
     """
     name = models.CharField(max_length=255, unique=True, db_index=True)
     default_expire = models.PositiveIntegerField(default=5, help_text="In minutes.")
+    enqueued_total = models.PositiveIntegerField(default=0, editable=False, help_text="Messages ever added.")
+    completed_total = models.PositiveIntegerField(default=0, editable=False, help_text="Jobs ever completed.")
+    failed_total = models.PositiveIntegerField(default=0, editable=False, help_text="Job attempts ever failed.")
+    objects = QueueManager()
 
     def __str__(self):
         return self.name
 
+    def is_dead_letter_queue(self):
+        return self.name.endswith(DEAD_LETTER_SUFFIX)
+
+    def dead_letter_queue(self):
+        """Returns the queue that messages which keep failing on this queue are moved to"""
+        q, created = Queue.objects.get_or_create(name=self.name + DEAD_LETTER_SUFFIX)
+        return q
+
+    def source_queue(self):
+        """For a dead letter queue, returns the queue its messages came from"""
+        return Queue.objects.get(name=self.name[:-len(DEAD_LETTER_SUFFIX)])
+
     class Admin:
         pass
 
 class MessageManager(models.Manager):
+    def push(self, queue, message, key=None):
+        """ adds `message` to the queue and returns (message, created).
+        
+        If `key` is given and a visible message with the same key is already waiting in
+        the queue, that message is returned instead of adding a new one.  A message that
+        has been popped and is being worked on doesn't count, so a job that is already
+        running gets exactly one follow-up.
+        
+        The check and the insert are a single INSERT ... SELECT, and on PostgreSQL and
+        MySQL the queue row is locked first, so two pushes at the same time can't both
+        find nothing waiting.
+        
+        queue can either be the name of a queue or an instance of Queue.
+        """
+        q = isinstance(queue, Queue) and queue or Queue.objects.get(name=queue)
+        if key is None:
+            result = Message(queue=q, message=message)
+            result.save()
+            queue_notifier.notify(q.name)
+            return result, True
+        from django.db import connection, transaction
+        qn = connection.ops.quote_name
+        queue_table = qn(Queue._meta.db_table)
+        table = qn(self.model._meta.db_table)
+        while True:
+            cursor = connection.cursor()
+            if settings.DATABASE_ENGINE.startswith('postgresql') or settings.DATABASE_ENGINE == 'mysql':
+                cursor.execute("SELECT id FROM %s WHERE id=%%s FOR UPDATE" % queue_table, [q.id])
+            now = datetime.datetime.now()
+            cursor.execute("INSERT INTO %s (queue_id, message, visible, timestamp, coalesce_key, attempts) \
+                           SELECT id, %%s, %%s, %%s, %%s, %%s FROM %s WHERE id=%%s AND NOT EXISTS \
+                           (SELECT id FROM %s WHERE queue_id=%%s AND coalesce_key=%%s AND visible=%%s)" % \
+                           (table, queue_table, table),
+                           [message, True, now, key, 0, q.id, q.id, key, True])
+            if cursor.rowcount > 0:
+                message_id = connection.ops.last_insert_id(cursor, self.model._meta.db_table, self.model._meta.pk.column)
+                transaction.commit_unless_managed()
+                Queue.objects.increment(q.id, 'enqueued_total')
+                queue_notifier.notify(q.name)
+                # Built rather than read back, as a worker may already have popped it
+                return Message(id=message_id, queue=q, message=message, visible=True, timestamp=now,
+                               coalesce_key=key, attempts=0), True
+            transaction.commit_unless_managed()
+            try:
+                return q.message_set.filter(coalesce_key=key, visible=True).order_by('timestamp', 'id')[0:1].get(), False
+            except Message.DoesNotExist:
+                # The waiting message was popped in the meantime, so try adding ours again
+                pass
+
+    def _queue_set(self, queue):
+        if queue is None:
+            # The following code allows us to do:
+            # q.message_set.pop() when we already have an instance of q at hand
+            return self
+        return isinstance(queue, Queue) and queue.message_set or \
+                                     self.filter(queue__name=queue)
+
+    def pop_many(self, queue=None, n=1, expire_interval=5):
+        """ returns a list of up to `n` visible Messages, oldest first, and sets
+        them to 'invisible' until after an expiration time (default of 5 minutes).
+        
+        The messages are claimed with a single conditional UPDATE, so two workers
+        popping at the same time never get the same message.  If
+        HGFRONT_QUEUE_SKIP_LOCKED is set and the database is PostgreSQL, rows another
+        worker is claiming are skipped rather than waited on.
+        
+        queue can either be the name of a queue or an instance of Queue.
+        """
+        from django.db import connection, transaction
+        candidates = self._queue_set(queue).filter(visible=True).order_by('timestamp', 'id').values('id')[:n]
+        candidate_sql, candidate_params = candidates.query.as_sql()
+        if getattr(settings, 'HGFRONT_QUEUE_SKIP_LOCKED', False) and settings.DATABASE_ENGINE.startswith('postgresql'):
+            candidate_sql += ' FOR UPDATE SKIP LOCKED'
+        claim = uuid.uuid4().hex
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        cursor = connection.cursor()
+        # The extra derived table is needed for MySQL, which can't select from the table it is updating
+        now = datetime.datetime.now()
+        cursor.execute("UPDATE %s SET visible=%%s, expires=%%s, claim=%%s, popped=%%s, attempts=attempts+1 \
+                       WHERE visible=%%s AND id IN (SELECT id FROM (%s) claimable)" % (table, candidate_sql),
+                       [False, now + datetime.timedelta(minutes=expire_interval), claim, now, True] + list(candidate_params))
+        transaction.commit_unless_managed()
+        if not cursor.rowcount:
+            return []
+        return list(self.model._default_manager.filter(claim=claim).select_related().order_by('timestamp', 'id'))
+
     def pop(self, queue=None, expire_interval=5):
         """ returns a visible Message if available, or None. Any Message
         returned is set to 'invisible', so that future pop() invocations won't 
@@ -212,25 +719,79 @@ class MessageManager(models.Manager):
         
         queue can either be the name of a queue or an instance of Queue.
         """
-        try:
-            if queue is None:
-                # The following code allows us to do:
-                # q.message_set.pop() when we already have an instance of q at hand
-                f = self
-            else:
-                f = isinstance(queue, Queue) and queue.message_set or \
-                                             self.filter(queue__name=queue)
-            result = f.filter(visible=True).order_by('timestamp', 'id')[0:1].get()
-            result.visible = False
-            result.expires = datetime.datetime.now() + datetime.timedelta(minutes=expire_interval)
-            result.save()
-            return result
-        except Message.DoesNotExist:
-            return None
+        messages = self.pop_many(queue, 1, expire_interval)
+        if messages:
+            return messages[0]
+        return None
+
+    def extend_expiration(self, message, expire_interval=5):
+        """
+        Pushes the expiration time of a popped message `expire_interval` minutes into the
+        future, so a job that is still running isn't handed to another worker.  Returns
+        False if the message has since been deleted or claimed by someone else.
+        """
+        from django.db import connection, transaction
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET expires=%%s WHERE id=%%s AND claim=%%s AND visible=%%s" % \
+                       connection.ops.quote_name(self.model._meta.db_table),
+                       [datetime.datetime.now() + datetime.timedelta(minutes=expire_interval), message.id, message.claim, False])
+        transaction.commit_unless_managed()
+        return bool(cursor.rowcount)
+
+    def complete(self, message):
+        """Deletes a message whose job has finished, recording how long the job took"""
+        JobTiming.objects.record(message, True)
+        Queue.objects.increment(message.queue_id, 'completed_total')
+        message.delete()
+
+    def fail(self, message):
+        """
+        Records that the job for a popped message has failed.  The message stays invisible
+        for a backoff that doubles with each attempt, starting at HGFRONT_QUEUE_RETRY_DELAY
+        minutes and going up to HGFRONT_QUEUE_MAX_RETRY_DELAY, after which the reaper makes
+        it visible to be retried.  Once it has been tried HGFRONT_QUEUE_MAX_ATTEMPTS times
+        it is moved to the dead letter queue instead.  Returns True if it was dead lettered.
+        """
+        JobTiming.objects.record(message, False)
+        Queue.objects.increment(message.queue_id, 'failed_total')
+        if should_dead_letter(message.attempts):
+            self.dead_letter(message)
+            return True
+        self.filter(id=message.id, claim=message.claim).update(
+            visible=False, expires=datetime.datetime.now() + datetime.timedelta(minutes=retry_delay(message.attempts)))
+        return False
+
+    def dead_letter(self, message):
+        """
+        Moves a message to the dead letter queue of its queue.  It is kept invisible with
+        no expiration, so it can't be popped from there until it is requeued.
+        """
+        self.filter(id=message.id).update(queue=message.queue.dead_letter_queue(), visible=False, expires=None)
+
+    def requeue(self, dead_letter_queue, ids=None):
+        """
+        Moves the messages in `ids`, or all of them, from a dead letter queue back onto the
+        queue they came from to be tried again.  Messages whose coalesce key is already
+        waiting there are deleted instead.  Returns the number of messages moved.
+        """
+        source_queue = dead_letter_queue.source_queue()
+        messages = self.filter(queue=dead_letter_queue)
+        if ids is not None:
+            messages = messages.filter(id__in=ids)
+        waiting_keys = source_queue.message_set.filter(visible=True, coalesce_key__isnull=False).values_list('coalesce_key', flat=True)
+        duplicates = coalesced_requeues(messages.order_by('timestamp', 'id').values_list('id', 'coalesce_key'), waiting_keys)
+        if duplicates:
+            self.filter(id__in=duplicates).delete()
+            messages = messages.exclude(id__in=duplicates)
+        count = messages.count()
+        messages.update(queue=source_queue, visible=True, expires=None, attempts=0, claim=None)
+        return count
 
     def clear_expirations(self, queue):
         """
-        Changes visibility to True for messages whose expiration time has elapsed.
+        Changes visibility to True for messages whose expiration time has elapsed, and
+        returns how many there were.  This is a range scan over the (queue_id, visible,
+        expires) index created in sql/message.sql, so it only touches expired rows.
         queue can either be the name of a queue or an instance of Queue.
         """
         q = isinstance(queue, Queue) and queue or Queue.objects.get(name=queue)
@@ -244,30 +805,89 @@ class MessageManager(models.Manager):
         except DatabaseError:
             # @RD: For thread safety: these updates could be allowed to fail silently
             # @RD: Perhaps, this isn't needed.
-            pass
+            return 0
         else:
             transaction.commit_unless_managed()
-        return None
+        return cursor.rowcount
+
+    def reap(self):
+        """
+        Clears the expirations of every queue, one queue at a time so each UPDATE can
+        use the index, and throws away job timings that are too old for the metrics.
+        Returns a dictionary of queue name to the number of messages made visible again.
+        """
+        JobTiming.objects.prune()
+        reaped = {}
+        for q in Queue.objects.all():
+            count = self.clear_expirations(q)
+            if count:
+                reaped[q.name] = count
+        return reaped
 
 class Message(models.Model):
     """
     """
+    queue = models.ForeignKey(Queue)
     message = models.TextField()
     visible = models.BooleanField(default=True, db_index=True)
     expires = models.DateTimeField(null=True, blank=True, db_index=True,
                 help_text="After this time has elapsed, the visibility of the message \
                            is changed back from False to True (when clear_expirations is executed).")
     timestamp = models.DateTimeField(null=True, blank=True, db_index=True, default=datetime.datetime.now)
+    coalesce_key = models.CharField(max_length=255, null=True, blank=True, db_index=True,
+                help_text="Messages with the same key are coalesced while they wait in the queue.")
+    attempts = models.PositiveIntegerField(default=0,
+                help_text="The number of times the message has been popped.")
+    popped = models.DateTimeField(null=True, blank=True, editable=False,
+                help_text="When the message was last popped.")
+    claim = models.CharField(max_length=32, null=True, blank=True, db_index=True, editable=False,
+                help_text="Identifies the pop that last claimed the message.")
     objects = MessageManager()
     
     def save(self):
-        if not self.id:
+        created = not self.id
+        if created:
             self.timestamp = datetime.datetime.now()
         super(Message, self).save()
+        if created:
+            Queue.objects.increment(self.queue_id, 'enqueued_total')
+
+    def queue_name(self):
+        return self.queue.name
+    queue_name = property(queue_name)
     
     def __str__(self):
         return "QM<%s> : %s" % (self.id, self.message)
             
 #class MessageAdmin(admin.ModelAdmin):
 #    model = Message
-#    raw_id_fields = ('queue',)
\ No newline at end of file
+#    raw_id_fields = ('queue',)
+
+class JobTimingManager(models.Manager):
+    def record(self, message, succeeded):
+        """Records the outcome of the job for a popped message"""
+        now = datetime.datetime.now()
+        popped = message.popped or now
+        duration = now - popped
+        self.create(queue_id=message.queue_id, enqueued=message.timestamp, finished=now, succeeded=succeeded,
+                    duration=duration.days * 86400 + duration.seconds + duration.microseconds / 1000000.0)
+
+    def prune(self):
+        """Deletes the timings older than HGFRONT_QUEUE_METRICS_WINDOW seconds"""
+        window = getattr(settings, 'HGFRONT_QUEUE_METRICS_WINDOW', 3600)
+        self.filter(finished__lt=datetime.datetime.now() - datetime.timedelta(seconds=window)).delete()
+
+class JobTiming(models.Model):
+    """
+    How long a single run of a queue job took, kept for HGFRONT_QUEUE_METRICS_WINDOW
+    seconds to work out rates and percentiles for the queue metrics
+    """
+    queue = models.ForeignKey(Queue)
+    enqueued = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(db_index=True)
+    duration = models.FloatField(help_text="In seconds.")
+    succeeded = models.BooleanField(default=True)
+    objects = JobTimingManager()
+    
+    def __str__(self):
+        return "%s job finished %s in %.1fs" % (self.queue_id, self.finished, self.duration)
@@ -0,0 +1,47 @@
+# General Libraries
+import threading
+# Django Libraries
+# Project Libraries
+
+class QueueNotifier(object):
+    """
+    Lets threads in this process wait for a message to be added to a queue.  Each queue
+    has a counter that is bumped whenever a message is added to it, so a waiter that
+    read the counter before checking the queue won't miss a message added in between.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def version(self, queue_name):
+        """Returns the current counter for the queue"""
+        self._condition.acquire()
+        try:
+            return self._versions.get(queue_name, 0)
+        finally:
+            self._condition.release()
+
+    def notify(self, queue_name):
+        """Wakes everything waiting on the queue"""
+        self._condition.acquire()
+        try:
+            self._versions[queue_name] = self._versions.get(queue_name, 0) + 1
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def wait(self, queue_name, version, timeout):
+        """
+        Waits up to `timeout` seconds for a message to be added to the queue after
+        `version` was read.  Returns True if one was.
+        """
+        self._condition.acquire()
+        try:
+            if self._versions.get(queue_name, 0) == version:
+                self._condition.wait(timeout)
+            return self._versions.get(queue_name, 0) != version
+        finally:
+            self._condition.release()
+
+# The notifier shared by everything in this process
+queue_notifier = QueueNotifier()
@@ -0,0 +1,90 @@
+# General Libraries
+import threading
+from mercurial import hg, ui
+from mercurial.hgweb import common
+# Django Libraries
+from django.conf import settings
+# Project Libraries
+
+class RepositoryPool(object):
+    """
+    A per-process pool of open mercurial repository objects, keyed on the
+    repository directory.
+
+    Opening a repository means building a ui object and parsing the hgrc and
+    the store, so rather than doing this on every call we keep the handle
+    around and hand it back out until the changelog on disk has been
+    modified (by a push, pull or commit), at which point it is reopened.
+    The pool holds at most `max_size` handles, and the least recently used
+    handle is dropped when it is full.
+    """
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = getattr(settings, 'HGFRONT_REPO_POOL_SIZE', 20)
+        self.max_size = max_size
+        self._handles = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns an open repository for `path`, reusing the pooled handle if the
+        changelog has not changed since it was opened.
+        """
+        path = str(path)
+        mtime = common.get_mtime(path)
+        self._lock.acquire()
+        try:
+            if path in self._handles:
+                repository, opened_mtime = self._handles[path]
+                if opened_mtime == mtime:
+                    self._touch(path)
+                    return repository
+                self._remove(path)
+        finally:
+            self._lock.release()
+        # Open outside the lock so that a slow repository doesn't block the others
+        repository = hg.repository(ui.ui(), path)
+        self._lock.acquire()
+        try:
+            self._handles[path] = (repository, mtime)
+            self._touch(path)
+            while len(self._order) > self.max_size:
+                self._remove(self._order[0])
+        finally:
+            self._lock.release()
+        return repository
+
+    def discard(self, path):
+        """Drops the pooled handle for `path`, if there is one"""
+        self._lock.acquire()
+        try:
+            self._remove(str(path))
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Drops every pooled handle"""
+        self._lock.acquire()
+        try:
+            self._handles = {}
+            self._order = []
+        finally:
+            self._lock.release()
+
+    def _touch(self, path):
+        if path in self._order:
+            self._order.remove(path)
+        self._order.append(path)
+
+    def _remove(self, path):
+        if path in self._handles:
+            del self._handles[path]
+        if path in self._order:
+            self._order.remove(path)
+
+    def __len__(self):
+        return len(self._handles)
+
+# The pool shared by everything in this process
+repository_pool = RepositoryPool()
@@ -0,0 +1,240 @@
+"""
+The mercurial http wire protocol, served from the repository views so clones, pulls
+and pushes can go through Django and the repository pool rather than hgwebdir.cgi
+"""
+# General Libraries
+import base64, os, tempfile, zlib
+from cStringIO import StringIO
+from mercurial import changegroup, hg, streamclone, ui, util
+from mercurial.node import bin, hex
+# Django Libraries
+from django.contrib.auth import authenticate
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed
+# Project Libraries
+from repo.pool import repository_pool
+
+HGTYPE = 'application/mercurial-0.1'
+
+# Size of the chunks changegroups and store files are read in
+CHUNK_SIZE = 4096
+
+class HttpResponseUnauthorized(HttpResponse):
+    """Asks the mercurial client for a username and password"""
+    status_code = 401
+
+    def __init__(self, realm):
+        HttpResponse.__init__(self, 'Authorization required\n', mimetype='text/plain')
+        self['WWW-Authenticate'] = 'Basic realm="%s"' % realm
+
+def request_user(request):
+    """
+    Returns the user making the request.  Mercurial clients can't log in through a
+    session, so HTTP basic authentication is tried first.
+    """
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    if auth:
+        try:
+            method, data = auth.split(' ', 1)
+            if method.lower() == 'basic':
+                username, password = base64.b64decode(data).split(':', 1)
+                user = authenticate(username=username, password=password)
+                if user is not None and user.is_active:
+                    return user
+        except (ValueError, TypeError):
+            pass
+    return request.user
+
+def is_repo_member(repo, user):
+    """Returns True if `user` manages `repo` or is one of its local members"""
+    if not user.is_authenticated():
+        return False
+    return user.id == repo.local_manager_id or repo.local_members.filter(id=user.id).count() > 0
+
+def can_pull(repo, user):
+    if is_repo_member(repo, user):
+        return True
+    return repo.allow_anon_pull and repo.local_parent_project.get_permissions(user).view_repos
+
+def can_push(repo, user):
+    return repo.allow_anon_push or is_repo_member(repo, user)
+
+def _response(data):
+    return HttpResponse(data, mimetype=HGTYPE)
+
+def _nodes(request, name):
+    value = request.GET.get(name, '')
+    if not value:
+        return []
+    return map(bin, value.split(' '))
+
+def do_capabilities(request, repo, repository):
+    caps = ['lookup', 'changegroupsubset']
+    if repo.allow_stream_clone:
+        caps.append('stream=%d' % repository.changelog.version)
+    caps.append('unbundle=%s' % ','.join(changegroup.bundlepriority))
+    return _response(' '.join(caps))
+
+def do_lookup(request, repo, repository):
+    try:
+        resp = '1 %s\n' % hex(repository.lookup(request.GET.get('key', '')))
+    except Exception, inst:
+        resp = '0 %s\n' % inst
+    return _response(resp)
+
+def do_heads(request, repo, repository):
+    return _response(' '.join(map(hex, repository.heads())) + '\n')
+
+def do_branches(request, repo, repository):
+    resp = StringIO()
+    for branch in repository.branches(_nodes(request, 'nodes')):
+        resp.write(' '.join(map(hex, branch)) + '\n')
+    return _response(resp.getvalue())
+
+def do_between(request, repo, repository):
+    pairs = [map(bin, p.split('-')) for p in request.GET.get('pairs', '').split(' ') if p]
+    resp = StringIO()
+    for branch in repository.between(pairs):
+        resp.write(' '.join(map(hex, branch)) + '\n')
+    return _response(resp.getvalue())
+
+def compressed_chunks(source):
+    """Yields the zlib compressed contents of the file object `source` a chunk at a time"""
+    z = zlib.compressobj()
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield z.compress(chunk)
+    yield z.flush()
+
+def do_changegroup(request, repo, repository):
+    source = repository.changegroup(_nodes(request, 'roots'), 'serve')
+    return _response(compressed_chunks(source))
+
+def do_changegroupsubset(request, repo, repository):
+    source = repository.changegroupsubset(_nodes(request, 'bases'), _nodes(request, 'heads'), 'serve')
+    return _response(compressed_chunks(source))
+
+def stream_out_chunks(repository):
+    """
+    Yields the raw store of `repository` in the format expected by `hg clone --uncompressed`,
+    reading each store file as it is sent
+    """
+    try:
+        lock = repository.lock()
+    except Exception:
+        yield '2\n'
+        return
+    try:
+        entries = []
+        total_bytes = 0
+        decodefn = getattr(repository, 'decodefn', lambda name: name)
+        for name, size in streamclone.walkrepo(repository.spath):
+            entries.append((decodefn(util.pconvert(name)), size))
+            total_bytes += size
+    finally:
+        del lock
+    yield '0\n'
+    yield '%d %d\n' % (len(entries), total_bytes)
+    for name, size in entries:
+        yield '%s\0%d\n' % (name, size)
+        for chunk in util.filechunkiter(repository.sopener(name), limit=size):
+            yield chunk
+
+def do_stream_out(request, repo, repository):
+    if not repo.allow_stream_clone:
+        return _response('1\n')
+    return _response(stream_out_chunks(repository))
+
+def request_body(request):
+    """Returns the file object the body of `request` can be read from as it arrives"""
+    if hasattr(request, 'environ'):
+        return request.environ['wsgi.input']
+    return request._req
+
+def do_unbundle(request, repo, repository):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    # The pooled handle and its ui are shared with other threads, so the push gets a
+    # handle of its own to buffer the output of addchangegroup on
+    repository = hg.repository(ui.ui(), repo.repo_directory)
+    their_heads = request.GET.get('heads', '').split(' ')
+
+    def check_heads():
+        heads = map(hex, repository.heads())
+        return their_heads == [hex('force')] or their_heads == heads
+
+    if not check_heads():
+        return _response('0\nunsynced changes\n')
+
+    fd, tmp_path = tempfile.mkstemp(prefix='hg-unbundle-')
+    bundle = os.fdopen(fd, 'wb+')
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        for chunk in util.filechunkiter(request_body(request), CHUNK_SIZE, length):
+            bundle.write(chunk)
+        bundle.seek(0)
+        lock = repository.lock()
+        try:
+            if not check_heads():
+                return _response('0\nunsynced changes\n')
+            repository.ui.pushbuffer()
+            try:
+                gen = changegroup.readbundle(bundle, None)
+                url = 'remote:http:%s' % request.META.get('REMOTE_ADDR', '')
+                try:
+                    ret = repository.addchangegroup(gen, 'serve', url)
+                except util.Abort, inst:
+                    repository.ui.warn('abort: %s\n' % inst)
+                    ret = 0
+            finally:
+                output = repository.ui.popbuffer()
+        finally:
+            del lock
+    finally:
+        bundle.close()
+        os.unlink(tmp_path)
+    # The pooled handle has stale caches now, so the next request opens the repository again
+    repository_pool.discard(repo.repo_directory)
+    if ret:
+        repo.update_folder_size()
+        repo.save()
+        # Index the pushed changesets and check the clone bundle, as after a pull
+        from repo.jobs import after_content_change
+        after_content_change(repo)
+    return _response('%d\n%s' % (ret, output))
+
+PULL_COMMANDS = {
+    'capabilities': do_capabilities,
+    'lookup': do_lookup,
+    'heads': do_heads,
+    'branches': do_branches,
+    'between': do_between,
+    'changegroup': do_changegroup,
+    'changegroupsubset': do_changegroupsubset,
+    'stream_out': do_stream_out,
+}
+
+PUSH_COMMANDS = {
+    'unbundle': do_unbundle,
+}
+
+def hg_command(request, repo, cmd):
+    """
+    Runs the wire protocol command `cmd` against `repo` after checking that the user
+    may pull (or push, for unbundle) from it
+    """
+    user = request_user(request)
+    if cmd in PULL_COMMANDS:
+        command = PULL_COMMANDS[cmd]
+        allowed = can_pull(repo, user)
+    elif cmd in PUSH_COMMANDS:
+        command = PUSH_COMMANDS[cmd]
+        allowed = can_pull(repo, user) and can_push(repo, user)
+    else:
+        return HttpResponseForbidden('Unknown command: %s\n' % cmd)
+    if not allowed:
+        if user.is_authenticated():
+            return HttpResponseForbidden('Permission denied\n')
+        return HttpResponseUnauthorized(repo.display_name)
+    return command(request, repo, repo.get_repository())
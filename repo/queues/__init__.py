@@ -0,0 +1,40 @@
+"""
+The repository job queues can live in the main database or in a backend of their own,
+chosen by the HGFRONT_QUEUE_BACKEND setting in the same style as CACHE_BACKEND:
+
+    db://                           the Queue and Message models (the default)
+    sqlite:///var/hgfront/queue.db  a separate SQLite file in WAL mode, so queue
+                                    traffic doesn't add writes to the main database
+"""
+# General Libraries
+# Django Libraries
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+# Project Libraries
+from repo.queues.base import QueueDoesNotExist, DEAD_LETTER_SUFFIX
+
+BACKENDS = ('db', 'sqlite')
+
+def get_backend(backend_uri):
+    """Returns a new queue backend for `backend_uri`"""
+    if backend_uri.find(':') == -1:
+        raise ImproperlyConfigured("HGFRONT_QUEUE_BACKEND URI must start with scheme://")
+    scheme, rest = backend_uri.split(':', 1)
+    if not rest.startswith('//'):
+        raise ImproperlyConfigured("HGFRONT_QUEUE_BACKEND URI must start with scheme://")
+    if scheme not in BACKENDS:
+        raise ImproperlyConfigured("%r is not a valid queue backend" % scheme)
+    module = __import__('repo.queues.%s' % scheme, {}, {}, [''])
+    return module.QueueBackend(rest[2:])
+
+_backend = None
+
+def get_queue_backend():
+    """
+    Returns the backend set by HGFRONT_QUEUE_BACKEND, created the first time it is asked
+    for so the backends can import the models
+    """
+    global _backend
+    if _backend is None:
+        _backend = get_backend(getattr(settings, 'HGFRONT_QUEUE_BACKEND', 'db://'))
+    return _backend
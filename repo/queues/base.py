@@ -0,0 +1,146 @@
+# General Libraries
+# Django Libraries
+from django.conf import settings
+# Project Libraries
+
+# Messages that keep failing on a queue are moved to the queue with this added to its name
+DEAD_LETTER_SUFFIX = '_dead'
+
+class QueueDoesNotExist(Exception):
+    pass
+
+def retry_delay(attempts):
+    """
+    Returns how many minutes a message that has failed `attempts` times stays invisible,
+    starting at HGFRONT_QUEUE_RETRY_DELAY and doubling each time up to HGFRONT_QUEUE_MAX_RETRY_DELAY
+    """
+    delay = getattr(settings, 'HGFRONT_QUEUE_RETRY_DELAY', 1) * 2 ** max(attempts - 1, 0)
+    return min(delay, getattr(settings, 'HGFRONT_QUEUE_MAX_RETRY_DELAY', 240))
+
+def should_dead_letter(attempts):
+    """Returns True once a message has been tried HGFRONT_QUEUE_MAX_ATTEMPTS times"""
+    return attempts >= getattr(settings, 'HGFRONT_QUEUE_MAX_ATTEMPTS', 5)
+
+def coalesced_requeues(candidates, waiting_keys):
+    """
+    Given the (id, coalesce_key) pairs of dead letters about to be requeued, oldest
+    first, and the keys of the messages already waiting on the queue, returns the ids
+    that would duplicate a waiting message, or an older one being requeued with them
+    """
+    seen = set(waiting_keys)
+    duplicates = []
+    for message_id, key in candidates:
+        if key is None:
+            continue
+        if key in seen:
+            duplicates.append(message_id)
+        seen.add(key)
+    return duplicates
+
+class BaseQueueBackend(object):
+    """
+    The queue API.  Queues are named, and the messages handed out have at least the
+    attributes id, queue_name, message, timestamp, attempts, claim, expires and popped.
+    """
+    def __init__(self, location):
+        pass
+
+    def queue_names(self):
+        """Returns the names of all the queues, sorted"""
+        raise NotImplementedError
+
+    def create_queue(self, queue_name):
+        """Creates the queue if it doesn't exist yet"""
+        raise NotImplementedError
+
+    def default_expire(self, queue_name):
+        """Returns the default visibility timeout of the queue, raising QueueDoesNotExist if there is no such queue"""
+        raise NotImplementedError
+
+    def push(self, queue_name, message, key=None):
+        """
+        Adds `message` to the queue, creating the queue if needed, and returns
+        (message, created).  If `key` is given and a visible message with the same key is
+        already waiting, that message is returned instead of adding a new one.
+        """
+        raise NotImplementedError
+
+    def pop_many(self, queue_name, n=1, expire_interval=5):
+        """
+        Returns up to `n` visible messages, oldest first, and makes them invisible for
+        `expire_interval` minutes.  No two callers ever get the same message.
+        """
+        raise NotImplementedError
+
+    def pop(self, queue_name, expire_interval=5):
+        """Pops a single message, or returns None if the queue is empty"""
+        messages = self.pop_many(queue_name, 1, expire_interval)
+        if messages:
+            return messages[0]
+        return None
+
+    def extend_expiration(self, message, expire_interval=5):
+        """
+        Pushes the expiration of a popped message `expire_interval` minutes into the
+        future.  Returns False if it has since been deleted or claimed by someone else.
+        """
+        raise NotImplementedError
+
+    def get_claimed(self, queue_name, message_id, claim):
+        """Returns the message `message_id` if it is still held under `claim`, otherwise None"""
+        raise NotImplementedError
+
+    def complete(self, message):
+        """Deletes a message whose job has finished, recording how long the job took"""
+        raise NotImplementedError
+
+    def fail(self, message):
+        """
+        Records that the job for a popped message has failed.  The message stays
+        invisible for retry_delay() minutes, or is dead lettered once should_dead_letter()
+        says so.  Returns True if it was dead lettered.
+        """
+        raise NotImplementedError
+
+    def dead_letter(self, message):
+        """Moves a message to the dead letter queue of its queue"""
+        raise NotImplementedError
+
+    def messages(self, queue_name):
+        """Returns every message in the queue, oldest first"""
+        raise NotImplementedError
+
+    def requeue(self, queue_name, ids=None):
+        """
+        Moves the messages in `ids`, or all of them, from the dead letter queue of
+        `queue_name` back onto it.  Messages whose coalesce key is already waiting on the
+        queue are deleted instead, as the waiting message does the same job.  Returns the
+        number of messages moved.
+        """
+        raise NotImplementedError
+
+    def count(self, queue_name):
+        """Returns the number of visible messages in the queue"""
+        raise NotImplementedError
+
+    def clear_expirations(self, queue_name):
+        """Makes the messages whose expiration has passed visible again and returns how many there were"""
+        raise NotImplementedError
+
+    def reap(self):
+        """
+        Clears the expirations of every queue and throws away job timings older than
+        HGFRONT_QUEUE_METRICS_WINDOW.  Returns a dictionary of queue name to the number
+        of messages made visible again.
+        """
+        raise NotImplementedError
+
+    def stats(self, queue_name, since):
+        """
+        Returns a dictionary with the number of `visible` and `in_flight` messages, the
+        timestamp of the `oldest` visible message (or None), the `enqueued_total`,
+        `completed_total` and `failed_total` counters, the number of messages
+        `enqueued` and jobs `failed` since the datetime `since`, and the sorted
+        `durations` in seconds of the jobs completed since then.
+        """
+        raise NotImplementedError
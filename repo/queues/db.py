@@ -0,0 +1,94 @@
+"""
+The queue backend on the Queue and Message models in the main database
+"""
+# General Libraries
+# Django Libraries
+# Project Libraries
+from repo.models import Queue, Message, JobTiming
+from repo.queues.base import BaseQueueBackend, QueueDoesNotExist, DEAD_LETTER_SUFFIX
+
+class QueueBackend(BaseQueueBackend):
+    def queue_names(self):
+        return [q.name for q in Queue.objects.order_by('name')]
+
+    def create_queue(self, queue_name):
+        Queue.objects.get_or_create(name=queue_name)
+
+    def _get_queue(self, queue_name):
+        try:
+            return Queue.objects.get(name=queue_name)
+        except Queue.DoesNotExist:
+            raise QueueDoesNotExist(queue_name)
+
+    def default_expire(self, queue_name):
+        return self._get_queue(queue_name).default_expire
+
+    def push(self, queue_name, message, key=None):
+        q, created = Queue.objects.get_or_create(name=queue_name)
+        return Message.objects.push(q, message, key)
+
+    def pop_many(self, queue_name, n=1, expire_interval=5):
+        return Message.objects.pop_many(queue_name, n, expire_interval)
+
+    def extend_expiration(self, message, expire_interval=5):
+        return Message.objects.extend_expiration(message, expire_interval)
+
+    def get_claimed(self, queue_name, message_id, claim):
+        try:
+            return Message.objects.select_related().get(id=message_id, queue__name=queue_name, claim=claim)
+        except Message.DoesNotExist:
+            return None
+
+    def complete(self, message):
+        Message.objects.complete(message)
+
+    def fail(self, message):
+        return Message.objects.fail(message)
+
+    def dead_letter(self, message):
+        Message.objects.dead_letter(message)
+
+    def messages(self, queue_name):
+        return list(Message.objects.filter(queue__name=queue_name).select_related().order_by('timestamp', 'id'))
+
+    def requeue(self, queue_name, ids=None):
+        self._get_queue(queue_name)
+        try:
+            dead_queue = Queue.objects.get(name=queue_name + DEAD_LETTER_SUFFIX)
+        except Queue.DoesNotExist:
+            return 0
+        return Message.objects.requeue(dead_queue, ids)
+
+    def count(self, queue_name):
+        return self._get_queue(queue_name).message_set.filter(visible=True).count()
+
+    def clear_expirations(self, queue_name):
+        return Message.objects.clear_expirations(self._get_queue(queue_name))
+
+    def reap(self):
+        return Message.objects.reap()
+
+    def stats(self, queue_name, since):
+        q = self._get_queue(queue_name)
+        messages = q.message_set.all()
+        visible = messages.filter(visible=True)
+        try:
+            oldest = visible.order_by('timestamp', 'id')[0:1].get().timestamp
+        except Message.DoesNotExist:
+            oldest = None
+        timings = JobTiming.objects.filter(queue=q, finished__gte=since)
+        durations = list(timings.filter(succeeded=True).values_list('duration', flat=True))
+        durations.sort()
+        return {
+            'visible': visible.count(),
+            'in_flight': messages.filter(visible=False).count(),
+            'oldest': oldest,
+            'enqueued_total': q.enqueued_total,
+            'completed_total': q.completed_total,
+            'failed_total': q.failed_total,
+            # Messages added since then are either still in the table or have completed
+            'enqueued': messages.filter(timestamp__gte=since).count() + \
+                        timings.filter(succeeded=True, enqueued__gte=since).count(),
+            'failed': timings.filter(succeeded=False).count(),
+            'durations': durations,
+        }
@@ -0,0 +1,289 @@
+"""
+A queue backend in a SQLite file of its own, opened in WAL mode so readers never wait on
+the writer.  Queue polling, claiming and deleting then never touch the main database.
+Each process (and thread) opens its own connection, so it is safe to use from the
+forked children of the queue worker.
+"""
+# General Libraries
+import os, time, datetime, threading, uuid
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+# Django Libraries
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+# Project Libraries
+from repo.notify import queue_notifier
+from repo.queues.base import BaseQueueBackend, QueueDoesNotExist, DEAD_LETTER_SUFFIX, coalesced_requeues, retry_delay, should_dead_letter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queues (
+    name TEXT PRIMARY KEY,
+    default_expire INTEGER NOT NULL DEFAULT 5,
+    enqueued_total INTEGER NOT NULL DEFAULT 0,
+    completed_total INTEGER NOT NULL DEFAULT 0,
+    failed_total INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    message TEXT NOT NULL,
+    visible INTEGER NOT NULL DEFAULT 1,
+    expires REAL,
+    timestamp REAL NOT NULL,
+    coalesce_key TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    popped REAL,
+    claim TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_pop ON messages (queue, visible, timestamp, id);
+CREATE INDEX IF NOT EXISTS messages_expires ON messages (queue, visible, expires);
+CREATE INDEX IF NOT EXISTS messages_key ON messages (queue, coalesce_key);
+CREATE INDEX IF NOT EXISTS messages_claim ON messages (claim);
+CREATE TABLE IF NOT EXISTS timings (
+    id INTEGER PRIMARY KEY,
+    queue TEXT NOT NULL,
+    enqueued REAL,
+    finished REAL NOT NULL,
+    duration REAL NOT NULL,
+    succeeded INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timings_finished ON timings (queue, finished);
+"""
+
+MESSAGE_COLUMNS = 'id, queue, message, timestamp, attempts, claim, expires, popped'
+
+def _datetime(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value)
+
+class QueueMessage(object):
+    """A message read from the queue file"""
+    def __init__(self, row):
+        self.id, self.queue_name, self.message, timestamp, self.attempts, self.claim, expires, popped = row
+        self.times = (timestamp, popped)
+        self.timestamp = _datetime(timestamp)
+        self.expires = _datetime(expires)
+        self.popped = _datetime(popped)
+
+    def __str__(self):
+        return "QM<%s> : %s" % (self.id, self.message)
+
+class QueueBackend(BaseQueueBackend):
+    def __init__(self, location):
+        if not location:
+            raise ImproperlyConfigured("The sqlite queue backend needs a file, as in sqlite:///path/to/queue.db")
+        self.path = location
+        self._local = threading.local()
+
+    def _connection(self):
+        # A connection must not be used across a fork, so one is kept per process and thread
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _transaction(self, func, *args):
+        """Runs func(cursor, *args) in a write transaction and returns what it returns"""
+        cursor = self._connection().cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(cursor, *args)
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return result
+
+    def _query(self, sql, params=()):
+        return self._connection().execute(sql, params).fetchall()
+
+    def queue_names(self):
+        return [row[0] for row in self._query('SELECT name FROM queues ORDER BY name')]
+
+    def create_queue(self, queue_name):
+        self._transaction(self._create_queue, queue_name)
+
+    def _create_queue(self, cursor, queue_name):
+        cursor.execute('INSERT OR IGNORE INTO queues (name) VALUES (?)', (queue_name,))
+
+    def default_expire(self, queue_name):
+        rows = self._query('SELECT default_expire FROM queues WHERE name=?', (queue_name,))
+        if not rows:
+            raise QueueDoesNotExist(queue_name)
+        return rows[0][0]
+
+    def push(self, queue_name, message, key=None):
+        result, created = self._transaction(self._push, queue_name, message, key)
+        if created:
+            queue_notifier.notify(queue_name)
+        return result, created
+
+    def _push(self, cursor, queue_name, message, key):
+        self._create_queue(cursor, queue_name)
+        if key is not None:
+            cursor.execute('SELECT %s FROM messages WHERE queue=? AND coalesce_key=? AND visible=1 LIMIT 1' % \
+                           MESSAGE_COLUMNS, (queue_name, key))
+            row = cursor.fetchone()
+            if row:
+                return QueueMessage(row), False
+        now = time.time()
+        cursor.execute('INSERT INTO messages (queue, message, timestamp, coalesce_key) VALUES (?, ?, ?, ?)',
+                       (queue_name, message, now, key))
+        message_id = cursor.lastrowid
+        cursor.execute('UPDATE queues SET enqueued_total = enqueued_total + 1 WHERE name=?', (queue_name,))
+        return QueueMessage((message_id, queue_name, message, now, 0, None, None, None)), True
+
+    def pop_many(self, queue_name, n=1, expire_interval=5):
+        return self._transaction(self._pop_many, queue_name, n, expire_interval)
+
+    def _pop_many(self, cursor, queue_name, n, expire_interval):
+        # The write lock is held from BEGIN IMMEDIATE, so nobody else can claim these in between
+        now = time.time()
+        claim = uuid.uuid4().hex
+        cursor.execute('UPDATE messages SET visible=0, expires=?, claim=?, popped=?, attempts=attempts+1 \
+                       WHERE id IN (SELECT id FROM messages WHERE queue=? AND visible=1 ORDER BY timestamp, id LIMIT ?)',
+                       (now + expire_interval * 60, claim, now, queue_name, n))
+        if not cursor.rowcount:
+            return []
+        cursor.execute('SELECT %s FROM messages WHERE claim=? ORDER BY timestamp, id' % MESSAGE_COLUMNS, (claim,))
+        return [QueueMessage(row) for row in cursor.fetchall()]
+
+    def extend_expiration(self, message, expire_interval=5):
+        return self._transaction(self._update_claimed, message, 'expires=?', (time.time() + expire_interval * 60,))
+
+    def _update_claimed(self, cursor, message, assignments, params):
+        cursor.execute('UPDATE messages SET %s WHERE id=? AND claim=? AND visible=0' % assignments,
+                       tuple(params) + (message.id, message.claim))
+        return bool(cursor.rowcount)
+
+    def get_claimed(self, queue_name, message_id, claim):
+        rows = self._query('SELECT %s FROM messages WHERE id=? AND queue=? AND claim=?' % MESSAGE_COLUMNS,
+                           (message_id, queue_name, claim))
+        if not rows:
+            return None
+        return QueueMessage(rows[0])
+
+    def _record(self, cursor, message, succeeded):
+        now = time.time()
+        enqueued, popped = message.times
+        cursor.execute('INSERT INTO timings (queue, enqueued, finished, duration, succeeded) VALUES (?, ?, ?, ?, ?)',
+                       (message.queue_name, enqueued, now, now - (popped or now), succeeded and 1 or 0))
+        counter = succeeded and 'completed_total' or 'failed_total'
+        cursor.execute('UPDATE queues SET %s = %s + 1 WHERE name=?' % (counter, counter), (message.queue_name,))
+
+    def complete(self, message):
+        self._transaction(self._complete, message)
+
+    def _complete(self, cursor, message):
+        self._record(cursor, message, True)
+        cursor.execute('DELETE FROM messages WHERE id=?', (message.id,))
+
+    def fail(self, message):
+        return self._transaction(self._fail, message)
+
+    def _fail(self, cursor, message):
+        self._record(cursor, message, False)
+        if should_dead_letter(message.attempts):
+            self._dead_letter(cursor, message)
+            return True
+        self._update_claimed(cursor, message, 'expires=?', (time.time() + retry_delay(message.attempts) * 60,))
+        return False
+
+    def dead_letter(self, message):
+        self._transaction(self._dead_letter, message)
+
+    def _dead_letter(self, cursor, message):
+        dead_queue = message.queue_name + DEAD_LETTER_SUFFIX
+        self._create_queue(cursor, dead_queue)
+        # Invisible with no expiration, so nothing pops it until it is requeued
+        cursor.execute('UPDATE messages SET queue=?, visible=0, expires=NULL WHERE id=?', (dead_queue, message.id))
+
+    def messages(self, queue_name):
+        return [QueueMessage(row) for row in self._query(
+            'SELECT %s FROM messages WHERE queue=? ORDER BY timestamp, id' % MESSAGE_COLUMNS, (queue_name,))]
+
+    def requeue(self, queue_name, ids=None):
+        self.default_expire(queue_name)
+        return self._transaction(self._requeue, queue_name, ids)
+
+    def _requeue(self, cursor, queue_name, ids):
+        where = 'queue=?'
+        params = [queue_name + DEAD_LETTER_SUFFIX]
+        if ids is not None:
+            if not ids:
+                return 0
+            where += ' AND id IN (%s)' % ', '.join(['?'] * len(ids))
+            params.extend(ids)
+        cursor.execute('SELECT coalesce_key FROM messages WHERE queue=? AND visible=1 AND coalesce_key IS NOT NULL',
+                       (queue_name,))
+        waiting_keys = [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT id, coalesce_key FROM messages WHERE %s ORDER BY timestamp, id' % where, params)
+        duplicates = coalesced_requeues(cursor.fetchall(), waiting_keys)
+        if duplicates:
+            cursor.execute('DELETE FROM messages WHERE id IN (%s)' % ', '.join(['?'] * len(duplicates)), duplicates)
+        cursor.execute('UPDATE messages SET queue=?, visible=1, expires=NULL, attempts=0, claim=NULL WHERE %s' % where,
+                       [queue_name] + params)
+        return cursor.rowcount
+
+    def count(self, queue_name):
+        self.default_expire(queue_name)
+        return self._query('SELECT COUNT(*) FROM messages WHERE queue=? AND visible=1', (queue_name,))[0][0]
+
+    def clear_expirations(self, queue_name):
+        self.default_expire(queue_name)
+        return self._transaction(self._clear_expirations, queue_name)
+
+    def _clear_expirations(self, cursor, queue_name):
+        cursor.execute('UPDATE messages SET expires=NULL, visible=1 WHERE queue=? AND visible=0 AND expires < ?',
+                       (queue_name, time.time()))
+        return cursor.rowcount
+
+    def reap(self):
+        return self._transaction(self._reap)
+
+    def _reap(self, cursor):
+        window = getattr(settings, 'HGFRONT_QUEUE_METRICS_WINDOW', 3600)
+        cursor.execute('DELETE FROM timings WHERE finished < ?', (time.time() - window,))
+        reaped = {}
+        for queue_name in [row[0] for row in cursor.execute('SELECT name FROM queues').fetchall()]:
+            count = self._clear_expirations(cursor, queue_name)
+            if count:
+                reaped[queue_name] = count
+        return reaped
+
+    def stats(self, queue_name, since):
+        since = time.mktime(since.timetuple())
+        rows = self._query('SELECT enqueued_total, completed_total, failed_total FROM queues WHERE name=?', (queue_name,))
+        if not rows:
+            raise QueueDoesNotExist(queue_name)
+        enqueued_total, completed_total, failed_total = rows[0]
+        visible, oldest = self._query('SELECT COUNT(*), MIN(timestamp) FROM messages WHERE queue=? AND visible=1',
+                                      (queue_name,))[0]
+        in_flight = self._query('SELECT COUNT(*) FROM messages WHERE queue=? AND visible=0', (queue_name,))[0][0]
+        durations = [row[0] for row in self._query(
+            'SELECT duration FROM timings WHERE queue=? AND finished >= ? AND succeeded=1 ORDER BY duration',
+            (queue_name, since))]
+        # Messages added since then are either still in the queue or have completed
+        enqueued = self._query('SELECT COUNT(*) FROM messages WHERE queue=? AND timestamp >= ?', (queue_name, since))[0][0] + \
+                   self._query('SELECT COUNT(*) FROM timings WHERE queue=? AND finished >= ? AND succeeded=1 AND enqueued >= ?',
+                               (queue_name, since, since))[0][0]
+        failed = self._query('SELECT COUNT(*) FROM timings WHERE queue=? AND finished >= ? AND succeeded=0',
+                             (queue_name, since))[0][0]
+        return {
+            'visible': visible,
+            'in_flight': in_flight,
+            'oldest': _datetime(oldest),
+            'enqueued_total': enqueued_total,
+            'completed_total': completed_total,
+            'failed_total': failed_total,
+            'enqueued': enqueued,
+            'failed': failed,
+            'durations': durations,
+        }
@@ -32,14 +32,35 @@ def create_repo(sender, instance, signal, *args, **kwargs):
 def move_repo():
     """TODO: Have code that checks if a project has changed in the DB and needs moved"""
     
+def publish_clone_bundle(sender, instance, signal, *args, **kwargs):
+    """Publishes or withdraws the clone bundle, as the repository may have been made public or private"""
+    try:
+        instance.publish_clone_bundle()
+    except (IOError, OSError):
+        pass
+
+def publish_project_clone_bundles(sender, instance, signal, *args, **kwargs):
+    """
+    Publishes or withdraws the clone bundles of every repository of a project when its
+    default permission set changes, as that decides whether anyone may pull them
+    """
+    from project.signals import deleting_projects
+    from repo.models import Repo
+    if not instance.is_default or instance.project_id in deleting_projects:
+        return
+    project_id = instance.project_id
+    for repo in Repo.objects.filter(local_parent_project__id=project_id, clone_bundle_rev__isnull=False):
+        publish_clone_bundle(sender, repo, signal)
+
+def unpublish_clone_bundle(sender, instance, signal, *args, **kwargs):
+    """Removes the published clone bundle of a deleted repository"""
+    public_path = instance.public_clone_bundle_path
+    if public_path and os.path.exists(public_path):
+        os.unlink(public_path)
+
 def delete_repo(sender, instance, signal, *args, **kwargs):
     """Destroy the mercurial repo"""
+    from repo.pool import repository_pool
+    repository_pool.discard(instance.repo_directory)
     if bool(os.path.isdir(instance.repo_directory)):
         return bool(shutil.rmtree(instance.repo_directory))
-    
-def get_repo_size(sender, instance, signal, *args, **kwargs):
-    instance.folder_size = 0
-    for (path, dirs, files) in os.walk(instance.repo_directory):
-        for file in files:
-            filename = os.path.join(path, file)
-            instance.folder_size += os.path.getsize(filename)
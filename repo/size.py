@@ -0,0 +1,144 @@
+# General Libraries
+import os, stat, time, cPickle
+from mercurial.hgweb import common
+# Django Libraries
+from django.conf import settings
+# Project Libraries
+
+# The name of the file the directory totals are kept in, inside the .hg directory
+SIZE_CACHE_FILE = 'hgfront.sizecache'
+
+def _scan_directory(path):
+    """
+    Returns the total size of the files directly inside `path` and a list of the
+    names of its subdirectories
+    """
+    total = 0
+    subdirs = []
+    for name in os.listdir(path):
+        try:
+            st = os.lstat(os.path.join(path, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.append(name)
+        elif stat.S_ISREG(st.st_mode) and name != SIZE_CACHE_FILE:
+            total += st.st_size
+    return total, subdirs
+
+def _touched_directories(directory):
+    """
+    Mercurial appends to revlogs in place, which doesn't change the mtime of the
+    directory they live in.  The undo journal of the last transaction lists every
+    revlog it appended to, so the directories holding those are returned here to be
+    rescanned as well.
+    """
+    touched = set()
+    for store in (os.path.join('.hg', 'store'), '.hg'):
+        try:
+            undo = open(os.path.join(directory, store, 'undo'))
+        except IOError:
+            continue
+        try:
+            for line in undo:
+                filename = line.split('\0', 1)[0]
+                touched.add(os.path.dirname(os.path.join(store, filename)))
+        finally:
+            undo.close()
+        break
+    return touched
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _content_token(directory):
+    """
+    Returns a (store, working copy) pair of values.  The first changes whenever the
+    changelog or the store is written to, the second whenever the working copy is updated.
+    """
+    store = (common.get_mtime(directory), _mtime(os.path.join(directory, '.hg', 'store')))
+    return (store, _mtime(os.path.join(directory, '.hg', 'dirstate')))
+
+def _load_cache(cache_path):
+    try:
+        cache_file = open(cache_path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return cPickle.load(cache_file)
+        except:
+            return None
+    finally:
+        cache_file.close()
+
+def _save_cache(cache_path, cache):
+    tmp_path = cache_path + '.tmp'
+    try:
+        cache_file = open(tmp_path, 'wb')
+        try:
+            cPickle.dump(cache, cache_file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            cache_file.close()
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        pass
+
+def calculate_repo_size(directory, full=False):
+    """
+    Returns the size in bytes of everything under the repository `directory`.
+
+    The total of each directory is cached along with the directory mtime in
+    .hg/hgfront.sizecache, and only directories that have changed since the last
+    call are listed again.  Nothing is scanned at all when neither the store nor
+    the working copy have changed.  hg update rewrites files in place without
+    touching their directory, so once the dirstate has changed every working copy
+    directory is listed again, while the directories under .hg stay cached.
+    Anything else missed is caught by a full rescan once the cache is older than
+    HGFRONT_REPO_SIZE_FULL_SCAN seconds, or when `full` is True.
+    """
+    directory = str(directory)
+    cache_path = os.path.join(directory, '.hg', SIZE_CACHE_FILE)
+    full_scan_interval = getattr(settings, 'HGFRONT_REPO_SIZE_FULL_SCAN', 24 * 60 * 60)
+    token = _content_token(directory)
+    now = time.time()
+
+    cache = _load_cache(cache_path)
+    if full or cache is None or now - cache['full_scan'] > full_scan_interval:
+        cache = {'full_scan': now, 'token': None, 'total': 0, 'dirs': {}}
+    elif cache['token'] == token:
+        return cache['total']
+
+    old_dirs = cache['dirs']
+    touched = _touched_directories(directory)
+    working_copy_changed = cache['token'] is None or cache['token'][1] != token[1]
+    dirs = {}
+    total = 0
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        path = os.path.join(directory, rel)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        entry = old_dirs.get(rel)
+        in_working_copy = rel != '.hg' and not rel.startswith('.hg' + os.sep)
+        if entry is None or entry[0] != mtime or rel in touched or (in_working_copy and working_copy_changed):
+            try:
+                size, subdirs = _scan_directory(path)
+            except OSError:
+                continue
+            entry = (mtime, size, subdirs)
+        dirs[rel] = entry
+        total += entry[1]
+        pending.extend([os.path.join(rel, subdir) for subdir in entry[2]])
+
+    cache['token'] = token
+    cache['total'] = total
+    cache['dirs'] = dirs
+    _save_cache(cache_path, cache)
+    return total
@@ -0,0 +1,2 @@
+-- Lets the expiration reaper find the expired messages of a queue without scanning the whole table
+CREATE INDEX repo_message_queue_visible_expires ON repo_message (queue_id, visible, expires);
@@ -15,13 +15,22 @@ urlpatterns = patterns('repo.views',
     url(r'^(?P<repo_name>[-\w]+)/$', 'view_changeset', name='view-tip'),
     url(r'^(?P<repo_name>[-\w]+)/delete/$','repo_delete', name='repo-delete'),
     url(r'^(?P<repo_name>[-\w]+)/pull/$','repo_pull_request', name='repo-pull-request'),
+    url(r'^(?P<repo_name>[-\w]+)/log/$', 'repo_log', name='repo-log'),
+    url(r'^(?P<repo_name>[-\w]+)/log/json/$', 'repo_log', {'response_type': 'json'}, name='repo-log-json'),
     url(r'^(?P<repo_name>[-\w]+)/changeset/(?P<changeset>[-\w]+)/$', 'view_changeset', name='view-changeset'),
+    url(r'^(?P<repo_name>[-\w]+)/bundle/$', 'repo_bundle', name='repo-bundle'),
+    url(r'^(?P<repo_name>[-\w]+)/archive/(?P<changeset>[-\w.]+)/(?P<archive_type>\w+)/$', 'repo_archive', name='repo-archive'),
 )
 
 urlpatterns += patterns('repo.views',
     url(r'^q/listqueues/$', 'list_queues'),
+    url(r'^q/metrics/$', 'metrics'),
+    url(r'^q/metrics/prometheus/$', 'metrics', {'response_type': 'prometheus'}),
     url(r'^q/(?P<queue_name>\w+)/clearexpire/$', 'clear_expirations'),
     url(r'^q/(?P<queue_name>\w+)/count/$', 'count', {"response_type":"text"}),
+    url(r'^q/(?P<queue_name>\w+)/poll/$', 'long_poll_queue'),
+    url(r'^q/(?P<queue_name>\w+)/dead/$', 'dead_letters'),
+    url(r'^q/(?P<queue_name>\w+)/(?P<message_id>\d+)/delete/$', 'delete_message'),
     url(r'^q/(?P<queue_name>\w+)/$', 'pop_queue'),
 
 )
\ No newline at end of file
@@ -1,13 +1,13 @@
 #General Libraries
 from mercurial import hg, ui, hgweb, commands, util, streamclone
 from mercurial.node import bin, hex
-from mercurial.hgweb import protocol
-import datetime, os, sys
+import datetime, os, sys, time
+from itertools import islice
 # Django Libraries
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound, HttpResponseServerError
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseRedirect, HttpResponseNotFound, HttpResponseServerError
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 from django.utils import simplejson
@@ -16,10 +16,21 @@ from django.utils.translation import gettext_lazy as _
 from core.libs.json_libs import json_encode, JsonResponse
 from project.decorators import check_project_permissions
 from project.models import Project
+from project.permissions import get_permissions
+from repo.archive import ARCHIVE_TYPES, file_chunks, repo_archive_chunks
 from repo.forms import RepoCreateForm
-from repo.models import Repo, Queue, Message
+from repo.jobs import JOBS, run_job
+from repo.metrics import queue_metrics, prometheus_text
+from repo.models import Repo, changelog_length
+from repo.notify import queue_notifier
+from repo.queues import get_queue_backend, QueueDoesNotExist, DEAD_LETTER_SUFFIX
+from repo.protocol import can_pull, hg_command, request_user, HttpResponseUnauthorized
 from repo.decorators import check_allowed_methods
 
+# The default and largest number of changesets on a page of the changelog
+LOG_PAGE_SIZE = 50
+LOG_MAX_PAGE_SIZE = 500
+
 @check_project_permissions('view_repos')
 def repo_list(request, slug):
     """
@@ -31,77 +42,144 @@ def repo_list(request, slug):
         {
             'project': project,
             'repos': repos,
-            'permissions': project.get_permissions(request.user),
+            'permissions': get_permissions(request, project),
             'json_output': json_encode({'repos' : repos, 'project' : project})
         }, context_instance=RequestContext(request)
     )
 
-@check_project_permissions('view_repos')
 def view_changeset(request, slug, repo_name, changeset='tip'):
+    """
+    Shows a changeset of the repository, or answers a mercurial client when the
+    request carries a wire protocol `cmd`
+    """
+    cmd = request.GET.get('cmd','')
+    if cmd:
+        project = get_object_or_404(Project, project_id__exact=slug)
+        repo = get_object_or_404(Repo, directory_name__exact=repo_name, local_parent_project__exact=project)
+        return hg_command(request, repo, cmd)
+    return changeset_detail(request, slug=slug, repo_name=repo_name, changeset=changeset)
+
+@check_project_permissions('view_repos')
+def changeset_detail(request, slug, repo_name, changeset='tip'):
     project = Project.projects.get(project_id__exact=slug)
     repo = Repo.objects.get(directory_name__exact=repo_name, local_parent_project__exact = project)
     
-    cmd = request.GET.get('cmd','')
-    if cmd:
-        if cmd == 'heads':
-            #u = ui.ui()
-            #loc = hg.repository(u, repo.repo_directory)
-            #resp = " ".join(map(hex, loc.heads())) + "\n"
-            #return HttpResponse(resp, mimetype='application/mercurial-0.1')
-            return HttpResponse('Not yet implemented')
+    snapshot = repo.changeset_snapshot(changeset)
+    if snapshot:
+        snapshot_output = snapshot.to_dict()
     else:
-        try:
-            changeset_tags = repo.get_tags()
-        except:
-            changeset_tags = []            
-        try:
-            changeset_branches = repo.get_branches()
-        except:
-            changeset_branches = []
-        try:
-            changeset_id = repo.get_changeset(changeset)
-        except:
-            changeset_id = []
-        try:
-            changeset_user = repo.get_changeset(changeset).user()
-        except:
-            changeset_user = []
-        try:
-            changeset_notes = repo.get_changeset(changeset).description()
-        except:
-            changeset_notes = []
-        try:
-            changeset_files = repo.get_changeset(changeset).files()
-        except:
-            changeset_files = []
-        try:
-            changeset_number = repo.get_changeset_number(changeset)
-        except:
-            changeset_number = []
-        try:
-            changeset_children = repo.get_next_changeset(changeset)
-        except:
-            changeset_children = []
-        try:
-            changeset_parents = repo.get_previous_changeset(changeset)
-        except:
-            changeset_parents = []
-        return render_to_response('repos/repo_detail.html',
-            {
-                'changeset_tags': changeset_tags,
-                'changeset_branches': changeset_branches,
-                'changeset_id': changeset_id,
-                'changeset_user': changeset_user,
-                'changeset_notes': changeset_notes,
-                'changeset_files': changeset_files,
-                'changeset_number': changeset_number,
-                'changeset_parents': changeset_parents,
-                'changeset_children': changeset_children,
-                'project': project,
-                'repo': repo,
-                'json_output': json_encode({'repo' : repo, 'project' : project})
-            }, context_instance=RequestContext(request)
-        )
+        snapshot_output = None
+    if repo.clone_bundle_rev is not None:
+        clone_bundle_url = request.build_absolute_uri(reverse('repo-bundle', kwargs={'slug': slug, 'repo_name': repo_name}))
+    else:
+        clone_bundle_url = None
+    return render_to_response('repos/repo_detail.html',
+        {
+            'changeset': snapshot,
+            'clone_bundle_url': clone_bundle_url,
+            'repo_url': request.build_absolute_uri(repo.get_absolute_url()),
+            'project': project,
+            'repo': repo,
+            'json_output': json_encode({'repo' : repo, 'project' : project, 'changeset' : snapshot_output})
+        }, context_instance=RequestContext(request)
+    )
+
+@check_project_permissions('view_repos')
+def repo_log(request, slug, repo_name, response_type='html'):
+    """
+    Shows a page of the repository changelog, newest first.  Pages are keyed on the
+    revision number rather than an offset, so `?before=<rev>&limit=N` returns the N
+    changesets below `rev` and only those changesets are read from the changelog.
+    """
+    project = get_object_or_404(Project, project_id__exact=slug)
+    repo = get_object_or_404(Repo, directory_name__exact=repo_name, local_parent_project__exact=project)
+    
+    try:
+        before = int(request.GET['before'])
+    except (KeyError, ValueError):
+        before = None
+    try:
+        limit = int(request.GET.get('limit', LOG_PAGE_SIZE))
+    except ValueError:
+        limit = LOG_PAGE_SIZE
+    limit = max(1, min(limit, LOG_MAX_PAGE_SIZE))
+    
+    try:
+        # Read one extra changeset so we know if there is another page
+        entries = list(islice(repo.changelog_entries(before), limit + 1))
+    except:
+        return HttpResponseNotFound()
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_before = entries[-1]['rev']
+    else:
+        next_before = None
+    
+    if response_type == 'json':
+        return HttpResponse(json_encode({'changesets': entries, 'next_before': next_before, 'limit': limit}), mimetype='application/json')
+    
+    if request.is_ajax():
+        template = 'repos/repo_log_ajax.html'
+    else:
+        template = 'repos/repo_log.html'
+    
+    return render_to_response(template,
+        {
+            'project': project,
+            'repo': repo,
+            'changesets': entries,
+            'next_before': next_before,
+            'limit': limit,
+            'json_output': json_encode({'repo' : repo, 'project' : project, 'changesets': entries, 'next_before': next_before}),
+        }, context_instance=RequestContext(request)
+    )
+
+@check_project_permissions('view_repos')
+def repo_archive(request, slug, repo_name, changeset, archive_type):
+    """
+    Streams an archive of the changeset in one of the formats allowed by the repository's
+    archive_types.  The archive is built as it is sent, so it never sits in memory.
+    """
+    project = get_object_or_404(Project, project_id__exact=slug)
+    repo = get_object_or_404(Repo, directory_name__exact=repo_name, local_parent_project__exact=project)
+    if archive_type not in ARCHIVE_TYPES or archive_type not in repo.allowed_archive_types:
+        return HttpResponseNotFound()
+    # An empty repository would only fail once the response had started streaming
+    if not changelog_length(repo.get_repository()):
+        return HttpResponseNotFound()
+    try:
+        chunks, filename = repo_archive_chunks(repo, changeset, archive_type)
+    except:
+        return HttpResponseNotFound()
+    response = HttpResponse(chunks, mimetype=ARCHIVE_TYPES[archive_type][2])
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+def repo_bundle(request, slug, repo_name):
+    """
+    Sends the pre-generated clone bundle of the repository to users that may pull from
+    it.  If HGFRONT_CLONE_BUNDLE_URL is set, and the bundle has been published to
+    HGFRONT_CLONE_BUNDLE_DIR because anyone may pull the repository, the client is
+    redirected to the web server to fetch it as a static file.
+    """
+    project = get_object_or_404(Project, project_id__exact=slug)
+    repo = get_object_or_404(Repo, directory_name__exact=repo_name, local_parent_project__exact=project)
+    user = request_user(request)
+    if not can_pull(repo, user):
+        if user.is_authenticated():
+            return HttpResponseForbidden('Permission denied\n')
+        return HttpResponseUnauthorized(repo.display_name)
+    if repo.clone_bundle_rev is None or not os.path.isfile(repo.clone_bundle_path):
+        return HttpResponseNotFound()
+    bundle_url = getattr(settings, 'HGFRONT_CLONE_BUNDLE_URL', None)
+    public_path = repo.public_clone_bundle_path
+    # The static URL is not authenticated, so only public bundles are sent there
+    if bundle_url and public_path and os.path.isfile(public_path) and repo.clone_bundle_is_public():
+        return HttpResponseRedirect('%s%s/%s.hg' % (bundle_url, project.project_id, repo.directory_name))
+    response = HttpResponse(file_chunks(repo.clone_bundle_path), mimetype='application/mercurial-0.1')
+    response['Content-Disposition'] = 'attachment; filename=%s.hg' % repo.directory_name
+    response['Content-Length'] = str(os.path.getsize(repo.clone_bundle_path))
+    return response
 
 def repo_create(request, slug):
     """
@@ -138,19 +216,11 @@ def repo_create(request, slug):
                 form.cleaned_data['created'] = True
                 form.save();
             else:
-                # We pass off to a queue event
-                msg_string = {}
-                
-                msg_string['directory_name'] = form.cleaned_data['directory_name']
-                msg_string['local_parent_project'] = project.project_id
-                
-                q = Queue.objects.get(name='repoclone')
-                clone = simplejson.dumps(msg_string)
-                msg = Message(message=clone, queue=q)
-                msg.save()
                 # Save the repo, save the world!
-                form.cleaned_data['created'] = False
-                form.save()
+                repo.created = False
+                repo = form.save()
+                # We pass off to a queue event
+                repo.queue_job('repoclone')
             
             request.user.message_set.create(message=_("The repository %(display_name)s has been queued") % {'display_name':form.cleaned_data['display_name'] })
             if request.is_ajax():
@@ -166,7 +236,7 @@ def repo_create(request, slug):
                 {
                     'form':form.as_table(),
                     'project':project,
-                    'permissions':project.get_permissions(request.user)
+                    'permissions':get_permissions(request, project)
                 }, context_instance=RequestContext(request)
             )
     else:
@@ -175,7 +245,7 @@ def repo_create(request, slug):
         {
             'form':form.as_table(),
             'project':project,
-            'permissions':project.get_permissions(request.user)
+            'permissions':get_permissions(request, project)
         }, context_instance=RequestContext(request)
     )
     
@@ -216,18 +286,13 @@ def repo_manage(request, slug, repo_name):
     
 def repo_pull_request(request, slug, repo_name):
     repo = Repo.objects.get(directory_name__exact = repo_name, local_parent_project__project_id__exact = slug)
-    # We pass off to a queue event
-    msg_string = {}
-                
-    msg_string['directory_name'] = repo.directory_name
-    msg_string['local_parent_project'] = repo.local_parent_project.project_id
-                
-    q = Queue.objects.get(name='repoupdate')
-    update = simplejson.dumps(msg_string)
-    msg = Message(message=update, queue=q)
+    # We pass off to a queue event, unless an update is already waiting
     try:
-        msg.save()
-        request.user.message_set.create(message="Your repository update has been queued!")
+        msg, created = repo.queue_job('repoupdate')
+        if created:
+            request.user.message_set.create(message="Your repository update has been queued!")
+        else:
+            request.user.message_set.create(message="An update of this repository is already queued!")
     except:
         request.user.message_set.create(message="The repository queue has failed!")
     return HttpResponseRedirect(reverse('view-tip', kwargs={'slug': slug, 'repo_name':repo_name}))
@@ -237,8 +302,8 @@ def list_queues(request):
     # test post with
     # curl -i http://localhost:8000/listqueues/
     result_list = []
-    for queue in Queue.objects.all():
-        result_list.append(queue.name)
+    for queue_name in get_queue_backend().queue_names():
+        result_list.append(queue_name)
     return HttpResponse(simplejson.dumps(result_list), mimetype='application/json')
 
 #
@@ -252,65 +317,133 @@ def pop_queue(request, queue_name):
     # curl -i http://localhost:8000/q/default/json/
     
     # print "GET queue_name is %s" % queue_name
-    q = None
+    backend = get_queue_backend()
     # pre-emptive queue name checking...
     try:
-        q = Queue.objects.get(name=queue_name)
-    except Queue.DoesNotExist:
+        expire_interval = backend.default_expire(queue_name)
+    except QueueDoesNotExist:
         return HttpResponseNotFound()
     #
-    msg = q.message_set.pop()
+    msg = backend.pop(queue_name, expire_interval)
     response_message='void'
-    if msg:
-        u = ui.ui()
-        message = json_encode(msg.message)
-        project = Project.projects.get(project_id__exact = message['local_parent_project'])
-        repo = Repo.objects.get(directory_name__exact=message['directory_name'], local_parent_project__exact=project)
-        
-        if (queue_name == 'repoclone'):
-            try:
-                hg.clone(u, str(repo.default_path), repo.repo_directory, True)
-                repo.created = True
-            except:
-                response_message = 'failed'
-            try:
-                m = Message.objects.get(id=msg.id, queue=q.id)
-                m.delete()
-                repo.save()
-                project.save()
-                response_message = 'success'
-            except:
-                response_message = 'failed'
-        elif (queue_name == 'repoupdate'):
-            location = hg.repository(u, repo.repo_directory)
-            try:
-                commands.pull(u, location, str(repo.default_path), rev=['tip'], force=True, update=True)
-                repo.folder_size = 0
-                for (path, dirs, files) in os.walk(repo.repo_directory):
-                    for file in files:
-                        filename = os.path.join(path, file)
-                        repo.folder_size += os.path.getsize(filename)
-                repo.save()
-                m = Message.objects.get(id=msg.id, queue=q.id)
-                m.delete()
-                project.save()
-                response_message = 'success'
-            except:
-                response_message = 'failed'
+    if msg and queue_name in JOBS:
+        if run_job(queue_name, msg):
+            response_message = 'success'
+        else:
+            response_message = 'failed'
     if (response_message == 'failed'):
         return HttpResponseServerError()
     else:
         return HttpResponse(response_message)
 
+@check_allowed_methods(['GET'])
+def long_poll_queue(request, queue_name):
+    """
+    Pops up to `max` messages from the queue and returns them as json, waiting up to
+    `wait` seconds for one to arrive if the queue is empty.  A message added from this
+    process wakes the request straight away, ones added elsewhere are seen on the next
+    check, which happens every HGFRONT_QUEUE_LONG_POLL_CHECK seconds.
+    Workers delete a message when they are done with it through its delete url.
+    """
+    # test with
+    # curl -i "http://localhost:8000/q/default/poll/?wait=30&max=10"
+    backend = get_queue_backend()
+    try:
+        default_expire = backend.default_expire(queue_name)
+    except QueueDoesNotExist:
+        return HttpResponseNotFound()
+    try:
+        wait = min(float(request.GET.get('wait', 0)), getattr(settings, 'HGFRONT_QUEUE_LONG_POLL_MAX', 30))
+        batch = max(1, min(int(request.GET.get('max', 1)), 100))
+        expire_interval = int(request.GET.get('expire', default_expire))
+    except ValueError:
+        return HttpResponseBadRequest()
+    check_interval = getattr(settings, 'HGFRONT_QUEUE_LONG_POLL_CHECK', 2)
+    
+    deadline = time.time() + wait
+    while True:
+        version = queue_notifier.version(queue_name)
+        messages = backend.pop_many(queue_name, batch, expire_interval)
+        remaining = deadline - time.time()
+        if messages or remaining <= 0:
+            break
+        queue_notifier.wait(queue_name, version, min(remaining, check_interval))
+    
+    result_list = [{
+        'id': m.id,
+        'message': m.message,
+        'claim': m.claim,
+        'expires': m.expires.strftime('%Y-%m-%d %H:%M:%S'),
+    } for m in messages]
+    return HttpResponse(simplejson.dumps(result_list), mimetype='application/json')
+
+@check_allowed_methods(['POST'])
+def delete_message(request, queue_name, message_id):
+    """
+    Deletes a message a worker has finished with.  The claim returned when it was popped
+    must be posted, so a message that expired and was handed to someone else is left alone.
+    """
+    # test with
+    # curl -i -d claim=... http://localhost:8000/q/default/1/delete/
+    backend = get_queue_backend()
+    message = backend.get_claimed(queue_name, int(message_id), request.POST.get('claim', ''))
+    if message is None:
+        return HttpResponseNotFound()
+    backend.complete(message)
+    return HttpResponse("", mimetype='text/plain')
+
+@check_allowed_methods(['GET', 'POST'])
+def dead_letters(request, queue_name):
+    """
+    Lists the messages that were dead lettered from the queue as json.  A POST moves
+    them back onto the queue, either the ones whose ids are posted as `id` or all of them.
+    """
+    # test with
+    # curl -i http://localhost:8000/q/default/dead/
+    # curl -i -d id=1 -d id=2 http://localhost:8000/q/default/dead/
+    backend = get_queue_backend()
+    try:
+        backend.default_expire(queue_name)
+    except QueueDoesNotExist:
+        return HttpResponseNotFound()
+    if request.method == 'POST':
+        ids = request.POST.getlist('id')
+        try:
+            count = backend.requeue(queue_name, ids and [int(i) for i in ids] or None)
+        except ValueError:
+            return HttpResponseBadRequest()
+        return HttpResponse(simplejson.dumps({"requeued": count}), mimetype='application/json')
+    result_list = [{
+        'id': m.id,
+        'message': m.message,
+        'attempts': m.attempts,
+        'timestamp': m.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+    } for m in backend.messages(queue_name + DEAD_LETTER_SUFFIX)]
+    return HttpResponse(simplejson.dumps(result_list), mimetype='application/json')
+
+@check_allowed_methods(['GET'])
+def metrics(request, response_type='json'):
+    """
+    Reports the depth, oldest message age, rates and job durations of every queue, as
+    json or in the Prometheus text format
+    """
+    # test with
+    # curl -i http://localhost:8000/q/metrics/
+    # curl -i http://localhost:8000/q/metrics/prometheus/
+    result = queue_metrics()
+    if response_type == 'prometheus':
+        return HttpResponse(prometheus_text(result), mimetype='text/plain; version=0.0.4')
+    return HttpResponse(simplejson.dumps(result), mimetype='application/json')
+
 #@check_allowed_methods(['POST'])
 def clear_expirations(request, queue_name):
     # test count with
     # curl -i http://localhost:8000/q/default/clearexpire/
     # @TODO: This should only work with a POST as the following code changes data
     try:
-        Message.objects.clear_expirations(queue_name)
+        get_queue_backend().clear_expirations(queue_name)
         return HttpResponse("", mimetype='text/plain')
-    except Queue.DoesNotExist:
+    except QueueDoesNotExist:
         return HttpResponseNotFound()
 
 @check_allowed_methods(['GET'])
@@ -319,12 +452,11 @@ def count(request, queue_name, response_type='text'):
     # curl -i http://localhost:8000/q/default/count/
     # curl -i http://localhost:8000/q/default/count/json/
     try:
-        q = Queue.objects.get(name=queue_name)
-        num_visible = q.message_set.filter(visible=True).count()
+        num_visible = get_queue_backend().count(queue_name)
         if response_type == 'json':
             msg_dict = {"count":"%s" % num_visible}
             return HttpResponse(simplejson.dumps(msg_dict), mimetype='application/json')
         else:
             return HttpResponse("%s" % num_visible, mimetype='text/plain')
-    except Queue.DoesNotExist:
+    except QueueDoesNotExist:
         return HttpResponseNotFound()
\ No newline at end of file
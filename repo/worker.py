@@ -0,0 +1,128 @@
+"""
+A queue worker that runs repository jobs in child processes, so clones and pulls don't
+tie up a web server process
+"""
+# General Libraries
+import os, signal, sys, time
+# Django Libraries
+from django.conf import settings
+from django.db import connection
+# Project Libraries
+from repo.jobs import JOBS, run_job
+from repo.queues import get_queue_backend
+
+class QueueWorker(object):
+    """
+    Polls the queues in `concurrency`, a dictionary of queue name to the number of jobs
+    from that queue that may run at once, and runs each job it pops in a forked child
+    process.  While a job runs its message's expiration is pushed back so no other
+    worker picks it up, and every `reap_interval` seconds messages from jobs that died
+    are made visible again.  On SIGTERM or SIGINT the worker stops popping and waits for the
+    running jobs to finish.
+    """
+    def __init__(self, concurrency, poll_interval=5, expire_interval=5, verbosity=1, reap_interval=None):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.expire_interval = expire_interval
+        self.verbosity = verbosity
+        if reap_interval is None:
+            reap_interval = getattr(settings, 'HGFRONT_QUEUE_REAP_INTERVAL', 60)
+        self.reap_interval = reap_interval
+        self.last_reap = 0
+        # pid: (queue_name, message, time the expiration was last extended)
+        self.running = {}
+        self.stopping = False
+
+    def log(self, message):
+        if self.verbosity > 0:
+            print "[%s] %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+            sys.stdout.flush()
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping:
+            self.log("Shutting down, waiting for %s running jobs" % len(self.running))
+        self.stopping = True
+
+    def running_count(self, queue_name):
+        return len([1 for q, m, t in self.running.values() if q == queue_name])
+
+    def start_job(self, queue_name, message):
+        # Children must not share the parent's database connection, so close it
+        # here and let both sides open their own
+        connection.close()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            status = 1
+            try:
+                if run_job(queue_name, message):
+                    status = 0
+            finally:
+                connection.close()
+                os._exit(status)
+        self.running[pid] = (queue_name, message, time.time())
+        self.log("Started %s job %s in process %s" % (queue_name, message.id, pid))
+
+    def reap(self):
+        """Collects the children that have finished"""
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            if pid in self.running:
+                queue_name, message, extended = self.running.pop(pid)
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                    self.log("Finished %s job %s" % (queue_name, message.id))
+                else:
+                    self.log("Failed %s job %s" % (queue_name, message.id))
+
+    def extend_running(self):
+        """Pushes back the expiration of jobs that have been running for half their timeout"""
+        now = time.time()
+        for pid, (queue_name, message, extended) in self.running.items():
+            if now - extended > self.expire_interval * 30:
+                get_queue_backend().extend_expiration(message, self.expire_interval)
+                self.running[pid] = (queue_name, message, now)
+
+    def reap_expired(self):
+        """Makes messages whose jobs died without finishing visible again"""
+        if not self.reap_interval or time.time() - self.last_reap < self.reap_interval:
+            return
+        self.last_reap = time.time()
+        for queue_name, count in get_queue_backend().reap().items():
+            self.log("Made %s expired messages on %s visible" % (count, queue_name))
+
+    def fill(self):
+        """Pops as many messages as there are free slots on each queue"""
+        for queue_name, limit in self.concurrency.items():
+            free = limit - self.running_count(queue_name)
+            if free <= 0:
+                continue
+            for message in get_queue_backend().pop_many(queue_name, free, self.expire_interval):
+                self.start_job(queue_name, message)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.log("Worker started for %s" % ', '.join(['%s (%s)' % q for q in self.concurrency.items()]))
+        while not self.stopping or self.running:
+            self.reap()
+            self.extend_running()
+            if not self.stopping:
+                try:
+                    self.reap_expired()
+                    self.fill()
+                except Exception, e:
+                    self.log("Failed to pop messages: %s" % e)
+            time.sleep(self.poll_interval)
+        self.log("Worker stopped")
+
+def default_concurrency():
+    """The HGFRONT_WORKER_CONCURRENCY setting, or one job at a time on every known queue"""
+    concurrency = dict([(name, 1) for name in JOBS])
+    concurrency.update(getattr(settings, 'HGFRONT_WORKER_CONCURRENCY', {}))
+    return concurrency
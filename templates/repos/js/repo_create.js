@@ -12,6 +12,7 @@ $(document).ready(function(){
 		data.default_path = $(form).find('input[@name=default_path]').val();
 		data.allow_anon_pull = $(form).find('input:checkbox[@name=allow_anon_pull]').val();
 		data.allow_anon_push = $(form).find('input:checkbox[@name=allow_anon_push]').val();
+		data.allow_stream_clone = $(form).find('input:checkbox[@name=allow_stream_clone]').val();
 		data.hgweb_style = $(form).find('select[@name=hgweb_style]').val();
 		data.archive_types = $(form).find('input[@name=archive_types]').val();
 		data.local_members = $(form).find('select[@name=local_members]').val();